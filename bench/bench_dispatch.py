@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""
+Matches per second of Parser rule dispatch, before and after indexing.
+
+Parses one chapter (by default the largest one) repeatedly with the
+current Parser._parse_handler and with the handler it replaced, which
+filtered every capture group of the combined regex on each match.
+
+    python bench/bench_dispatch.py [chapter] [--repeat 5]
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "lib"))
+
+import proc_stacks_chapter
+import stacks_project_info
+from proc_stacks_chapter import Parser
+
+def legacy_parse_handler(self, match):
+    self.current_match = match
+    key = match.lastgroup
+    rule = self.rules[key]
+    groups = match.groups()
+    groups = [ g for g in groups if g is not None ]
+    groups = groups[1:]
+    output = rule(self, *groups)
+    self.current_match = None
+    if output is None:
+        return ""
+    else:
+        return output
+
+def largest_chapter():
+    return max(stacks_project_info.chapters, key=lambda name: os.path.getsize(
+        os.path.join(proc_stacks_chapter.STACKS_DIR, name + ".tex")))
+
+def run(chapter, handler, repeat):
+    Parser._parse_handler = handler
+    best = None
+    for _ in range(repeat):
+        parser = Parser(chapter)
+        with open(parser.in_file_name, "r") as in_file:
+            tex_code = parser._preparse(in_file.read())
+        start = time.time()
+        parser.regex.sub(parser._parse_handler, tex_code)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    # Count matches, nested parses included, in a separate untimed run.
+    count = [0]
+    def counting(self, match):
+        count[0] += 1
+        return handler(self, match)
+    Parser._parse_handler = counting
+    parser = Parser(chapter)
+    parser.regex.sub(parser._parse_handler, tex_code)
+    Parser._parse_handler = handler
+    return count[0], best, len(tex_code)
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    arg_parser.add_argument("chapter", nargs="?")
+    arg_parser.add_argument("--repeat", type=int, default=5)
+    args = arg_parser.parse_args()
+    chapter = args.chapter or largest_chapter()
+    current_handler = Parser._parse_handler
+    results = [
+        ("before", run(chapter, legacy_parse_handler, args.repeat)),
+        ("after", run(chapter, current_handler, args.repeat)),
+    ]
+    print("chapter {}".format(chapter))
+    print("{:8} {:>10} {:>10} {:>14} {:>8}".format(
+        "handler", "matches", "seconds", "matches/s", "MB/s"))
+    for name, (matches, seconds, size) in results:
+        print("{:8} {:>10} {:>10.3f} {:>14.0f} {:>8.2f}".format(
+            name, matches, seconds, matches/seconds, size/seconds/1e6))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""
+Throughput and output of the alternation lexer against the first-char one.
+
+Parses the given chapters (by default the whole book) once with each
+Parser.lexer and reports MB/s of TeX source for each, overall and for
+the --top largest chapters, failing if any chapter comes out
+differently.  --stdlib-re hides the regex module so the comparison runs
+on top of the standard library re instead, and --no-math-state scans
+math with the full rule set, as before lexer states.
+
+    python bench/bench_lexer.py [chapter ...] [--stdlib-re] [--top 5]
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "lib"))
+
+LEXERS = ("alternation", "first-char")
+
+def parse_all(Parser, chapters, lexer):
+    Parser.lexer = lexer
+    bodies = {}
+    times = {}
+    for chapter in chapters:
+        parser = Parser(chapter)
+        start = time.time()
+        parser.parse()
+        times[chapter] = time.time() - start
+        bodies[chapter] = parser.bodies
+    return bodies, times
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    arg_parser.add_argument("chapters", nargs="*")
+    arg_parser.add_argument("--stdlib-re", action="store_true")
+    arg_parser.add_argument("--no-math-state", action="store_true")
+    arg_parser.add_argument("--top", type=int, default=5)
+    args = arg_parser.parse_args()
+    if args.stdlib_re:
+        sys.modules["regex"] = None
+    import proc_stacks_chapter
+    import stacks_project_info
+    Parser = proc_stacks_chapter.Parser
+    if args.no_math_state:
+        Parser.states[True] = Parser.states[False]
+    chapters = args.chapters or stacks_project_info.chapters
+    sizes = dict((chapter, os.path.getsize(Parser(chapter).in_file_name))
+                 for chapter in chapters)
+    size = sum(sizes.values())
+    print("{} chapters, {:.2f} MB, {} module".format(
+        len(chapters), size/1e6, proc_stacks_chapter.re.__name__))
+    results = {}
+    for lexer in LEXERS:
+        results[lexer] = parse_all(Parser, chapters, lexer)
+    print("{:24} {:>8} ".format("chapter", "KB") +
+          " ".join("{:>12}".format(lexer) for lexer in LEXERS))
+    largest = sorted(chapters, key=lambda chapter: -sizes[chapter])[:args.top]
+    for chapter in largest:
+        print("{:24} {:>8.0f} ".format(chapter, sizes[chapter]/1e3) +
+              " ".join("{:>7.2f} MB/s".format(
+                  sizes[chapter]/results[lexer][1][chapter]/1e6)
+                  for lexer in LEXERS))
+    print("{:24} {:>8.0f} ".format("total", size/1e3) +
+          " ".join("{:>7.2f} MB/s".format(
+              size/sum(results[lexer][1].values())/1e6) for lexer in LEXERS))
+    reference = results[LEXERS[0]][0]
+    different = [ chapter for chapter in chapters
+                  if any(results[lexer][0][chapter] != reference[chapter]
+                         for lexer in LEXERS[1:]) ]
+    if different:
+        print("output differs for: " + " ".join(different))
+        sys.exit(1)
+    print("output identical")
+
+if __name__ == "__main__":
+    main()
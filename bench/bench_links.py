@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""
+Time to resolve the cross-reference placeholders of the book, with the
+regex pass this replaced and with the single splicing pass.
+
+Parses the given chapters (by default the whole book) once, then
+resolves the links of every division body with each implementation,
+best of --repeat, and checks that they agree.  Reports the total and
+the --top chapters with the most placeholders per KB of output.
+
+    python bench/bench_links.py [chapter ...] [--repeat 5] [--top 5]
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "lib"))
+
+import stacks_project_info
+from proc_stacks_chapter import Parser, re, tag_cache
+
+LINK_REGEX = re.compile("\x01(.)(....)(?:\x03([^\x03]*)\x03)?")
+
+def legacy_fix_tag_links(self, chapter, division, body):
+    def aux_fix_tag_links(match):
+        mode = match.group(1)
+        tag = match.group(2)
+        try:
+            label_number, label_chapter, label_division, _ = tag_cache[tag]
+        except:
+            return "[" + tag + "]"
+        if self.chapter_name == label_chapter and division == label_division:
+            root = ""
+        else:
+            root = "{}-{:0>3}.html".format(label_chapter, label_division)
+        if mode == "t":
+            return root + "#" + tag
+        if mode == "a":
+            tmpl = "<a class='ref' href='{root}#{tag}'>{num}</a>"
+        else:
+            tmpl = "{num}"
+        if match.group(3) is not None:
+            label_number = match.group(3)
+        return tmpl.format(root=root, tag=tag, num=label_number)
+    return LINK_REGEX.sub(aux_fix_tag_links, body)
+
+def resolve(parser, fix_tag_links, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        bodies = [ fix_tag_links(parser, parser.chapter_name, division, body)
+                   for division, body in enumerate(parser.bodies)
+                   if division > 0 ]
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return bodies, best
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    arg_parser.add_argument("chapters", nargs="*")
+    arg_parser.add_argument("--repeat", type=int, default=5)
+    arg_parser.add_argument("--top", type=int, default=5)
+    args = arg_parser.parse_args()
+    chapters = args.chapters or stacks_project_info.chapters
+    parsers = [ Parser(chapter) for chapter in chapters ]
+    for parser in parsers:
+        parser.parse()
+    implementations = (("regex", legacy_fix_tag_links),
+                       ("splice", Parser._fix_tag_links))
+    rows = []
+    different = []
+    for parser in parsers:
+        size = sum(len(body) for body in parser.bodies[1:])
+        count = sum(body.count("\x01") for body in parser.bodies[1:])
+        results = [ resolve(parser, fix_tag_links, args.repeat)
+                    for _, fix_tag_links in implementations ]
+        if any(bodies != results[0][0] for bodies, _ in results[1:]):
+            different.append(parser.chapter_name)
+        rows.append((parser.chapter_name, size, count,
+                     [ seconds for _, seconds in results ]))
+    print("{:24} {:>8} {:>8} ".format("chapter", "KB", "links") +
+          " ".join("{:>10}".format(name + " ms") for name, _ in implementations))
+    def print_row(name, size, count, seconds):
+        print("{:24} {:>8.0f} {:>8} ".format(name, size/1e3, count) +
+              " ".join("{:>10.2f}".format(1000*s) for s in seconds))
+    dense = sorted(rows, key=lambda row: -row[2]/max(row[1], 1))
+    for row in dense[:args.top]:
+        print_row(*row)
+    print_row("total", sum(row[1] for row in rows), sum(row[2] for row in rows),
+              [ sum(row[3][i] for row in rows)
+                for i in range(len(implementations)) ])
+    if different:
+        print("output differs for: " + " ".join(different))
+        sys.exit(1)
+    print("output identical")
+
+if __name__ == "__main__":
+    main()
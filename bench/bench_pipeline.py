@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""
+Wall-clock time of a full build with and without the write pipeline.
+
+Runs a forced full build of the book once per build mode, each in a
+fresh interpreter and into the web/ directory of its own temporary
+project; nothing is written to the real web/.  --write-delay adds that many milliseconds to
+every page written, which stands in for a slow or networked web/
+directory: the sequential modes pay it once per page, while --pipeline
+overlaps it with parsing and spreads it over its writer threads.
+
+    python bench/bench_pipeline.py [--write-delay 5] [--writers 4]
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "lib"))
+
+MODES = ("default", "low-memory", "pipeline")
+
+def build(mode, delay, writers, tmp_dir):
+    import stacks_project_info
+    stacks_project_info.cache_file = os.path.join(tmp_dir, "info.cache")
+    import proc_stacks_chapter
+    from proc_stacks_chapter import Parser, tag_cache
+    proc_stacks_chapter.PROJECT_DIR = tmp_dir
+    tag_cache.tag_cache_file = os.path.join(tmp_dir, "web", "tag_cache.sqlite")
+    write_page = Parser.write_page
+    def slow_write_page(out_file_name, page):
+        time.sleep(delay)
+        write_page(out_file_name, page)
+    Parser.write_page = staticmethod(slow_write_page)
+    Parser.incremental = False
+    Parser.low_memory = mode != "default"
+    Parser.pipeline = mode == "pipeline"
+    Parser.writers = writers
+    devnull = open(os.devnull, "w")
+    stdout, sys.stdout = sys.stdout, devnull
+    start = time.time()
+    try:
+        Parser.process()
+    finally:
+        sys.stdout = stdout
+    return dict(seconds=time.time()-start)
+
+def run_build(mode, delay, writers):
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        os.mkdir(os.path.join(tmp_dir, "web"))
+        output = subprocess.check_output([
+            sys.executable, os.path.realpath(__file__),
+            "--build", mode, str(delay), str(writers), tmp_dir])
+    finally:
+        shutil.rmtree(tmp_dir)
+    return json.loads(output.decode().splitlines()[-1])
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    arg_parser.add_argument("--write-delay", type=float, default=5,
+                            help="milliseconds added to every page write")
+    arg_parser.add_argument("--writers", type=int, default=4)
+    arg_parser.add_argument("--build", nargs=4, help=argparse.SUPPRESS)
+    args = arg_parser.parse_args()
+    if args.build:
+        mode, delay, writers, tmp_dir = args.build
+        print(json.dumps(build(mode, float(delay), int(writers), tmp_dir)))
+        return
+    print("write delay {:.1f} ms, {} writer threads".format(
+        args.write_delay, args.writers))
+    print("{:12} {:>10}".format("mode", "seconds"))
+    for mode in MODES:
+        result = run_build(mode, args.write_delay/1000., args.writers)
+        print("{:12} {:>10.2f}".format(mode, result["seconds"]))
+
+if __name__ == "__main__":
+    main()
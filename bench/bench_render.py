@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+"""
+Time to render and write every page of the book, before and after the
+page templates.
+
+Parses the whole book once, then writes all divisions, their tables of
+contents and index.html into a directory on a RAM disk (/dev/shm when it
+exists), both with the page assembly this replaced, which built the
+templates with += and copied the header and footer from disk for every
+file, and with the current one.  Parsing is not timed, and the two sets
+of pages are checked to be identical.
+
+    python bench/bench_render.py [--dir /dev/shm] [--repeat 3]
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "lib"))
+
+import proc_stacks_chapter
+import stacks_project_info
+from proc_stacks_chapter import Parser, tag_cache
+
+def legacy_create_toc(self):
+    toc = ("<div class='toc'>\n" +
+           "<h2>Table of contents</h2>\n" +
+           "<ul>\n")
+    for sect_tag in tag_cache.children(self.chapter_tag):
+        number, chapter, division, title = tag_cache[sect_tag]
+        file = "{}-{:0>3}.html".format(chapter, division)
+        toc += "<li>"
+        toc += "<a class='toc-num' href='{}#{}'>".format(file, sect_tag)
+        toc += "&sect;" + number + "</a> "
+        toc += "<a class='toc-title' href='{}#{}'>".format(file, sect_tag)
+        toc += title + "</a>"
+        toc += "\n"
+    toc += "</ul>\n"
+    toc += "</div>\n"
+    return toc
+
+def legacy_write_html_file(self, out_file_name, body, nxt, prv, hme, div):
+    title = self.chapter_title
+    with open(out_file_name, "w") as out_file:
+        with open(self.header_file_name,"r") as header_file:
+            shutil.copyfileobj(header_file, out_file)
+        if body and body[-1]!="\n":
+            body += "\n"
+        tmpl = "<div class='chapter' id='{tag}'>{tagdiv}\n"
+        tmpl += "<div id='nav'>"
+        tmpl += "<a id='nav-next' {nxt}></a>"
+        tmpl += "<a id='nav-index' {hme}></a>"
+        tmpl += "<a id='nav-prev' {prv}></a>"
+        tmpl += "</div>\n"
+        tmpl += "<div class='pre-title'>Chapter {num}</div>\n"
+        tmpl += "<h1>{title}</h1>\n"
+        if div != 0:
+            tmpl += "<div class='post-title'>"
+            tmpl += "Sections &sect;{num}.{s0} to &sect;{num}.{s1}"
+            tmpl += "</div>\n"
+        tmpl += "{body}"
+        tmpl += "</div>"
+        print(tmpl.format(
+                tag=self.chapter_tag,
+                tagdiv=self._fix_tag_links(self.chapter_name, div,
+                                           self.chapter_tagdiv),
+                title=title, body=body, hme=hme, nxt=nxt, prv=prv,
+                num=self.chapter_number,
+                s0=self.division_first_section[div],
+                s1=self.division_last_section[div],
+            ), file=out_file)
+        with open(self.footer_file_name,"r") as footer_file:
+            shutil.copyfileobj(footer_file, out_file)
+
+def legacy_write_files(self):
+    for division, body in enumerate(self.bodies):
+        if division > 0:
+            body = self._fix_tag_links(self.chapter_name, division, body)
+        else:
+            body = legacy_create_toc(self)
+        out_file_name = self.out_file_name(division)
+        nxt, prv, hme = self._get_next_prev_home(self.chapter_name, division)
+        legacy_write_html_file(self, out_file_name, body, nxt, prv, hme,
+                               division)
+
+def legacy_write_complete_toc(cls):
+    toc_file_path = os.path.join(proc_stacks_chapter.PROJECT_DIR, "web",
+                                 "index.html")
+    with open(toc_file_path, "w") as toc_file:
+        with open(cls.header_file_name,"r") as header_file:
+            shutil.copyfileobj(header_file, toc_file)
+        body = "<div class='chapter' id='main-index'>\n"
+        body += "<h1>Stacks Project</h1>\n"
+        body += "<div class='toc'>\n"
+        body += "<h2>Table of contents</h2>\n"
+        body += "<ul>\n"
+        for part in tag_cache.children(""):
+            part_title = tag_cache[part].title
+            body += "<li class='toc-part'>"
+            body += part_title + "\n"
+            for chp_tag in tag_cache.children(part):
+                chp_number, chp_name, _, chp_title = tag_cache[chp_tag]
+                chp_file = "{}-{:0>3}.html".format(chp_name, 0)
+                body += "<li>"
+                body += "<a class='toc-num' href='{}'>".format(chp_file)
+                body += "Chapter " + chp_number + "</a> "
+                body += "<a class='toc-title' href='{}'>".format(chp_file)
+                body += chp_title + "</a>"
+                body += "\n"
+        body += "</ul>\n"
+        body += "</div>\n"
+        body += "</div>\n"
+        print(body, file=toc_file)
+        with open(cls.footer_file_name,"r") as footer_file:
+            shutil.copyfileobj(footer_file, toc_file)
+
+def current_write_files(self):
+    self.bodies[0] = self.create_toc()
+    self.write_files()
+
+def clear(web_dir):
+    for page in os.listdir(web_dir):
+        os.remove(os.path.join(web_dir, page))
+
+def render_all(parsers, web_dir, write_files, write_complete_toc):
+    # Every run starts from an empty directory, so that creating the files
+    # costs the same for both.
+    clear(web_dir)
+    Parser.page_parts = None
+    start = time.time()
+    for parser in parsers:
+        write_files(parser)
+    write_complete_toc(Parser)
+    return time.time() - start
+
+def read_pages(web_dir):
+    pages = {}
+    for name in os.listdir(web_dir):
+        with open(os.path.join(web_dir, name), "r") as page:
+            pages[name] = page.read()
+    return pages
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    arg_parser.add_argument("--dir",
+        default="/dev/shm" if os.path.isdir("/dev/shm") else None)
+    arg_parser.add_argument("--repeat", type=int, default=3)
+    args = arg_parser.parse_args()
+    tmp_dir = tempfile.mkdtemp(dir=args.dir)
+    try:
+        web_dir = os.path.join(tmp_dir, "web")
+        os.mkdir(web_dir)
+        proc_stacks_chapter.PROJECT_DIR = tmp_dir
+        parsers = [ Parser(chapter) for chapter in stacks_project_info.chapters ]
+        for parser in parsers:
+            parser.parse()
+        Parser.process_chapter_list()
+        modes = (
+            ("before", legacy_write_files, legacy_write_complete_toc),
+            ("after", current_write_files, Parser.write_complete_toc.__func__),
+        )
+        best = {}
+        pages = {}
+        # The modes take turns, so that both see the same page cache state.
+        for _ in range(args.repeat):
+            for name, write_files, write_complete_toc in modes:
+                seconds = render_all(parsers, web_dir, write_files,
+                                     write_complete_toc)
+                best[name] = min(best.get(name, seconds), seconds)
+                pages[name] = read_pages(web_dir)
+        results = [ (name, best[name]) for name, _, _ in modes ]
+        size = sum(len(page) for page in pages["after"].values())
+        print("{} pages, {:.1f} MB, written to {}".format(
+            len(pages["after"]), size/1e6, tmp_dir))
+        print("{:8} {:>10} {:>10}".format("render", "seconds", "MB/s"))
+        for name, seconds in results:
+            print("{:8} {:>10.3f} {:>10.1f}".format(name, seconds, size/seconds/1e6))
+        if pages["before"] != pages["after"]:
+            print("pages differ")
+            sys.exit(1)
+        print("pages identical")
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == "__main__":
+    main()
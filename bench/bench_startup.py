@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""
+Startup time of stacks_project_info and of a one-chapter build.
+
+Each measurement runs in a fresh interpreter, best of --repeat:
+
+  legacy  reading the tables through functions on import, as the module
+          did before its cache
+  cold    the module with no cache in web/ (it is rebuilt and written)
+  warm    the module with an up to date cache
+
+for loading the tables alone, and for the whole of
+`python lib/proc_stacks_chapter.py <chapter>`.
+
+    python bench/bench_startup.py [chapter] [--repeat 5]
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+LIB_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "lib")
+sys.path.insert(0, LIB_DIR)
+
+import stacks_project_info
+
+# stacks_project_info as it was before its cache, run in a module object
+# that stands in for it.
+LEGACY_INFO = (
+    "import sys\n"
+    "sys.path.append({scripts!r})\n"
+    "import functions\n"
+    "stacks_dir = {stacks_dir!r}\n"
+    "chapters = functions.list_text_files({stacks!r})\n"
+    "label_types = functions.list_of_standard_labels\n"
+    "tags = functions.get_tags({stacks!r})\n"
+    "_label_of_tag = dict(tags)\n"
+    "_tag_of_label = dict((l,t) for (t,l) in tags)\n"
+    "def tag2label(tag):\n"
+    "    return _label_of_tag[tag]\n"
+    "def label2tag(label):\n"
+    "    return _tag_of_label[label]\n"
+    "def chapter_number(name):\n"
+    "    return chapters.index(name)+1\n")
+
+LEGACY_MODULE = (
+    "import sys, types\n"
+    "info = types.ModuleType('stacks_project_info')\n"
+    "info.__file__ = {info_file!r}\n"
+    "exec({legacy!r}, info.__dict__)\n"
+    "sys.modules['stacks_project_info'] = info\n")
+
+LOAD = {
+    "legacy": LEGACY_MODULE + (
+        "info.chapter_number({chapter!r})\n"),
+    "module": (
+        "import sys\n"
+        "sys.path.insert(0, {lib!r})\n"
+        "import stacks_project_info\n"
+        "stacks_project_info.chapter_number({chapter!r})\n"),
+}
+
+# The build with the legacy tables in place of the module.
+LEGACY_BUILD = LEGACY_MODULE + (
+    "import runpy\n"
+    "sys.path.insert(0, {lib!r})\n"
+    "sys.argv = [{script!r}, {chapter!r}]\n"
+    "runpy.run_path({script!r}, run_name='__main__')\n")
+
+def remove_cache():
+    if os.path.exists(stacks_project_info.cache_file):
+        os.remove(stacks_project_info.cache_file)
+
+def run(command, repeat, before=None):
+    best = None
+    for _ in range(repeat):
+        if before is not None:
+            before()
+        start = time.time()
+        subprocess.check_call(command, stdout=open(os.devnull, "w"))
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    arg_parser.add_argument("chapter", nargs="?")
+    arg_parser.add_argument("--repeat", type=int, default=5)
+    args = arg_parser.parse_args()
+    chapter = args.chapter or stacks_project_info.chapters[0]
+    script = os.path.join(LIB_DIR, "proc_stacks_chapter.py")
+    names = dict(
+        lib=LIB_DIR,
+        scripts=os.path.join(stacks_project_info.stacks_dir, "scripts"),
+        stacks=os.path.join(stacks_project_info.stacks_dir, ""),
+        stacks_dir=stacks_project_info.stacks_dir,
+        info_file=os.path.join(LIB_DIR, "stacks_project_info.py"),
+        script=script,
+        chapter=chapter,
+    )
+    names["legacy"] = LEGACY_INFO.format(**names)
+    load = dict((kind, [sys.executable, "-c", code.format(**names)])
+                for kind, code in LOAD.items())
+    legacy_build = [sys.executable, "-c", LEGACY_BUILD.format(**names)]
+    build = [sys.executable, script, chapter]
+    rows = [
+        ("legacy", run(load["legacy"], args.repeat),
+                   run(legacy_build, args.repeat)),
+        ("cold", run(load["module"], args.repeat, remove_cache),
+                 run(build, args.repeat, remove_cache)),
+        ("warm", run(load["module"], args.repeat),
+                 run(build, args.repeat)),
+    ]
+    print("{} tags, chapter {}".format(len(stacks_project_info.tags), chapter))
+    print("{:8} {:>10} {:>10}".format("tables", "load ms", "build ms"))
+    for name, load_time, build_time in rows:
+        print("{:8} {:>10.1f} {:>10.1f}".format(name, 1000*load_time,
+                                                1000*build_time))
+
+if __name__ == "__main__":
+    main()
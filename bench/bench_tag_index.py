@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+"""
+Load time and memory of the SQLite tag index against the old JSON cache.
+
+A synthetic tag cache shaped like the whole Stacks Project (about 20000
+tags spread over 100 chapters) is written in both formats.  Each format
+is then loaded in a fresh interpreter, which reports the time to load
+it, the resident memory it added and the time for a batch of single
+tag lookups.
+
+    python bench/bench_tag_index.py [--tags 20000] [--chapters 100]
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "lib"))
+
+LOOKUPS = 1000
+
+def resident_kb():
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+def build_cache(tag_cache, n_tags, n_chapters):
+    # Chapters hold sections, which hold numbered environments, which hold
+    # equations and items, in roughly the proportions of the real book.
+    serial = [0]
+    def next_tag():
+        serial[0] += 1
+        return "{:04X}".format(serial[0])
+    per_chapter = n_tags // n_chapters
+    for c in range(1, n_chapters+1):
+        name = "chapter-{}".format(c)
+        tag_cache[next_tag()] = [str(c), name, 0, "Chapter {}".format(c)]
+        count = 1
+        s = 0
+        while count < per_chapter:
+            s += 1
+            division = 1 + s // 6
+            tag_cache[next_tag()] = ["{}.{}".format(c, s), name, division,
+                                     "Section {} of chapter {}".format(s, c)]
+            count += 1
+            for k in range(1, 16):
+                tag_cache[next_tag()] = ["{}.{}.{}".format(c, s, k), name,
+                                         division, ""]
+                count += 1
+                if k % 4 == 0:
+                    tag_cache[next_tag()] = ["{}.{}.{}.1".format(c, s, k),
+                                             name, division, ""]
+                    tag_cache[next_tag()] = [1, name, division, ""]
+                    count += 2
+    return ["{:04X}".format(t) for t in range(1, serial[0]+1)]
+
+def write_json(tag_cache, path):
+    # What TagCacheClass.save wrote before the SQLite index.
+    obj = dict(
+        tags=dict((tag, list(record)) for tag, record in tag_cache.tags.items()),
+        chapter_divisions=tag_cache.chapter_divisions,
+        tag_children=tag_cache.tag_children
+    )
+    with open(path, "w") as path_obj:
+        json.dump(obj, path_obj, indent=4)
+
+def measure(kind, path, tags):
+    import proc_stacks_chapter
+    before = resident_kb()
+    start = time.time()
+    if kind == "json":
+        with open(path, "r") as path_obj:
+            obj = json.load(path_obj)
+        lookup = obj["tags"].__getitem__
+    else:
+        tag_cache = proc_stacks_chapter.TagCacheClass()
+        tag_cache.tag_cache_file = path
+        tag_cache.load()
+        lookup = tag_cache.__getitem__
+    load_time = time.time() - start
+    sample = random.Random(0).sample(tags, min(LOOKUPS, len(tags)))
+    start = time.time()
+    for tag in sample:
+        lookup(tag)
+    lookup_time = time.time() - start
+    return dict(
+        load_ms=1000*load_time,
+        lookup_us=1e6*lookup_time/len(sample),
+        rss_kb=resident_kb()-before,
+    )
+
+def run_measure(kind, path, tags_path):
+    output = subprocess.check_output([
+        sys.executable, os.path.realpath(__file__),
+        "--measure", kind, path, tags_path])
+    return json.loads(output.decode().splitlines()[-1])
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    arg_parser.add_argument("--tags", type=int, default=20000)
+    arg_parser.add_argument("--chapters", type=int, default=100)
+    arg_parser.add_argument("--measure", nargs=3, help=argparse.SUPPRESS)
+    args = arg_parser.parse_args()
+    if args.measure:
+        kind, path, tags_path = args.measure
+        with open(tags_path) as tags_file:
+            tags = tags_file.read().split()
+        print(json.dumps(measure(kind, path, tags)))
+        return
+    import proc_stacks_chapter
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        tag_cache = proc_stacks_chapter.TagCacheClass()
+        tags = build_cache(tag_cache, args.tags, args.chapters)
+        tags_path = os.path.join(tmp_dir, "tags")
+        with open(tags_path, "w") as tags_file:
+            tags_file.write("\n".join(tags))
+        json_path = os.path.join(tmp_dir, "tag_cache.json")
+        write_json(tag_cache, json_path)
+        sqlite_path = os.path.join(tmp_dir, "tag_cache.sqlite")
+        tag_cache.tag_cache_file = sqlite_path
+        tag_cache.save()
+        print("{} tags in {} chapters".format(len(tags), args.chapters))
+        print("{:8} {:>10} {:>10} {:>12} {:>10}".format(
+            "format", "size KB", "load ms", "lookup us", "RSS KB"))
+        for kind, path in (("json", json_path), ("sqlite", sqlite_path)):
+            result = run_measure(kind, path, tags_path)
+            print("{:8} {:>10.0f} {:>10.2f} {:>12.2f} {:>10}".format(
+                kind, os.path.getsize(path)/1024., result["load_ms"],
+                result["lookup_us"], result["rss_kb"]))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == "__main__":
+    main()
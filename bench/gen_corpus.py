@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+"""
+Deterministic synthetic Stacks Project checkout for benchmarks.
+
+Writes chapters shaped like the real ones, with labelled sections and
+subsections, theorem environments with and without titles, proofs,
+labelled equations, enumerate and itemize lists with labelled and
+titled items, \\ref and \\hyperref within and across chapters,
+footnotes, citations, inline and display math with \\Hom, \\etale and
+friends, accents, quotes and dashes.  Alongside them it writes a
+matching tags/tags, a chapters.tex split into parts, a Makefile listing
+the chapters in LIJST and a scripts/functions.py with the three
+functions stacks_project_info needs, so the build can run on it with
+STACKS_PROJECT_DIR set:
+
+    python bench/gen_corpus.py /tmp/corpus --chapters 20 --sections 40
+    STACKS_PROJECT_DIR=/tmp/corpus python lib/proc_stacks_chapter.py
+
+The same arguments always give the same files.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import random
+
+FUNCTIONS = '''\
+# Stand-in for scripts/functions.py of the stacks-project repository,
+# written by bench/gen_corpus.py.
+
+list_of_standard_labels = ["definition", "lemma", "proposition", "theorem",
+    "remark", "remarks", "example", "exercise", "situation", "equation",
+    "item", "section", "subsection"]
+
+def list_text_files(path):
+    # The LIJST variable of the Makefile, as upstream reads it.
+    lijst = ""
+    in_list = False
+    with open(path + "Makefile") as makefile:
+        for line in makefile:
+            if line.startswith("LIJST = "):
+                in_list = True
+            if in_list:
+                lijst += line
+                in_list = line.rstrip().endswith("\\\\")
+    lijst = lijst.replace("LIJST = ", "").replace("\\\\\\n", "")
+    return lijst.split()
+
+def get_tags(path):
+    tags = []
+    with open(path + "tags/tags") as tags_file:
+        for line in tags_file:
+            if not line.startswith("#"):
+                tags.append(line.rstrip().split(","))
+    return tags
+'''
+
+WORDS = ("the scheme morphism sheaf module ring ideal is a of and flat "
+         "smooth separated finite type over every open covering affine "
+         "quasi-coherent locally free presentation field point").split()
+ENVS = ("lemma", "proposition", "theorem", "definition", "remark", "example")
+PARTS = ("Preliminaries", "Schemes", "Topics in Scheme Theory",
+         "Algebraic Spaces", "Moduli of Curves")
+
+class Corpus(object):
+
+    def __init__(self, out_dir, n_chapters, n_sections, seed):
+        self.out_dir = out_dir
+        self.n_chapters = n_chapters
+        self.n_sections = n_sections
+        self.random = random.Random(seed)
+        self.chapters = ["chapter-{}".format(c) for c in range(1, n_chapters+1)]
+        self.tags = []
+        self.labels = dict((chapter, []) for chapter in self.chapters)
+
+    def new_tag(self, label):
+        self.tags.append(("{:04X}".format(len(self.tags) + 0x10), label))
+
+    def text(self, n):
+        return " ".join(self.random.choice(WORDS) for _ in range(n))
+
+    def math(self):
+        return self.random.choice([
+            "$X \\to \\Spec(R)$",
+            "$\\Hom_R(M, N)$",
+            "$\\colim_i M_i$",
+            "$\\mathcal{O}_X$-module $\\mathcal{F}$",
+            "$U \\to X$ \\etale{}",
+            "$\\Ker(\\varphi) \\subset \\Im(\\psi)$",
+            "$\\lim_n A/I^n$",
+        ])
+
+    def reference(self, chapter, index):
+        # A \ref to an earlier label of this chapter or a \hyperref to a
+        # label of an earlier chapter.
+        if index > 0 and self.random.random() < 0.3:
+            other = self.chapters[self.random.randrange(index)]
+            if self.labels[other]:
+                return "\\hyperref[{}-{}]{{the {} lemma}}".format(
+                    other, self.random.choice(self.labels[other]),
+                    self.random.choice(["$\\lim$", "first", "Nakayama"]))
+        if self.labels[chapter]:
+            return "Lemma \\ref{{{}}}".format(self.random.choice(self.labels[chapter]))
+        return "Lemma \\ref{section-phantom}"
+
+    def paragraph(self, chapter, index):
+        sentences = []
+        for _ in range(self.random.randint(2, 5)):
+            sentence = self.text(self.random.randint(8, 20))
+            roll = self.random.random()
+            if roll < 0.25:
+                sentence += " " + self.math()
+            elif roll < 0.4:
+                sentence += ", see " + self.reference(chapter, index)
+            elif roll < 0.5:
+                sentence += "\\footnote{{Compare \\cite{{{}}} and {}.}}".format(
+                    self.random.choice(["EGA", "SGA4", "Hartshorne"]), self.text(6))
+            elif roll < 0.6:
+                sentence += " (``{}'' -- {}~{})".format(
+                    self.text(2), self.random.choice(["Poincar\\'e", "G\\\"odel",
+                    "Cech {\\v C}", "K\\\"unneth", "\\'{E}tale"]), self.text(1))
+            elif roll < 0.65:
+                sentence += " --- {{\\it {}}} and \\emph{{{}}}".format(
+                    self.text(2), self.text(2))
+            sentences.append(sentence[0].upper() + sentence[1:] + ".")
+        return " ".join(sentences) + "\n\n"
+
+    def environment(self, chapter, index, section, k, out):
+        env = self.random.choice(ENVS)
+        label = "{}-s{}-{}".format(env, section, k)
+        self.new_tag(chapter + "-" + label)
+        if self.random.random() < 0.3:
+            out.append("\\begin{{{}}}[{}]\n\\label{{{}}}\n".format(
+                env, self.text(2).title(), label))
+        else:
+            out.append("\\begin{{{}}}\n\\label{{{}}}\n".format(env, label))
+        out.append("Let {} be a {}. ".format(self.math(), self.text(4)))
+        out.append(self.paragraph(chapter, index))
+        if self.random.random() < 0.4:
+            equation = "equation-s{}-{}".format(section, k)
+            self.new_tag(chapter + "-" + equation)
+            out.append("\\begin{{equation}}\n\\label{{{}}}\n"
+                       "\\Hom_X(\\mathcal{{F}}, \\mathcal{{G}}) = "
+                       "\\lim \\Gamma(U_i, \\mathcal{{F}})\n"
+                       "\\end{{equation}}\n".format(equation))
+            self.labels[chapter].append(equation)
+        if self.random.random() < 0.5:
+            out.append("\\begin{enumerate}\n")
+            for i in range(self.random.randint(2, 4)):
+                if self.random.random() < 0.7:
+                    item = "item-s{}-{}-{}".format(section, k, i)
+                    self.new_tag(chapter + "-" + item)
+                    out.append("\\item {}\n\\label{{{}}}\n".format(self.text(6), item))
+                else:
+                    out.append("\\item[({})] {}\n".format("abcd"[i], self.text(6)))
+            out.append("\\end{enumerate}\n")
+        out.append("\\end{{{}}}\n\n".format(env))
+        if env not in ("definition", "example", "remark"):
+            out.append("\\begin{proof}\n")
+            out.append(self.paragraph(chapter, index))
+            if self.random.random() < 0.3:
+                out.append("$$\n\\xymatrix{{ {} \\ar[r] & {} }}\n$$\n".format(
+                    "A", "B"))
+                out.append("\\begin{{itemize}}\n\\item {}\n\\item {}\n"
+                           "\\end{{itemize}}\n".format(self.text(5), self.text(5)))
+            out.append("This finishes the proof.\n\\end{proof}\n\n")
+        self.labels[chapter].append(label)
+
+    def chapter(self, index):
+        chapter = self.chapters[index]
+        out = ["\\input{preamble}\n\\begin{document}\n",
+               "\\title{{{} {}}}\n\\maketitle\n\n\\phantomsection\n"
+               "\\label{{section-phantom}}\n\n\\tableofcontents\n\n".format(
+                   self.text(2).title(), index+1)]
+        for section in range(1, self.n_sections+1):
+            label = "section-s{}".format(section)
+            self.new_tag(chapter + "-" + label)
+            out.append("\\section{{{} on {}}}\n\\label{{{}}}\n\n".format(
+                self.text(2).title(), self.math(), label))
+            out.append(self.paragraph(chapter, index))
+            for k in range(self.random.randint(3, 8)):
+                self.environment(chapter, index, section, k, out)
+            if self.random.random() < 0.3:
+                label = "subsection-s{}".format(section)
+                self.new_tag(chapter + "-" + label)
+                out.append("\\subsection{{{}}}\n\\label{{{}}}\n\n".format(
+                    self.text(3).title(), label))
+                out.append("\\noindent\n" + self.paragraph(chapter, index))
+            self.labels[chapter].append("section-s{}".format(section))
+        out.append("\\input{chapters}\n\n\\bibliography{my}\n"
+                   "\\bibliographystyle{amsalpha}\n\n\\end{document}\n")
+        return "".join(out)
+
+    def write(self):
+        for sub_dir in ("scripts", "tags"):
+            if not os.path.isdir(os.path.join(self.out_dir, sub_dir)):
+                os.makedirs(os.path.join(self.out_dir, sub_dir))
+        with open(os.path.join(self.out_dir, "scripts", "functions.py"), "w") as f:
+            f.write(FUNCTIONS)
+        parts = min(len(PARTS), max(1, self.n_chapters // 4))
+        with open(os.path.join(self.out_dir, "chapters.tex"), "w") as f:
+            f.write("\\begin{itemize}\n")
+            for index, chapter in enumerate(self.chapters):
+                if index * parts % self.n_chapters < parts:
+                    f.write(PARTS[index * parts // self.n_chapters] + "\n")
+                f.write("\\item \\hyperref[{}-section-phantom]{{{}}}\n".format(
+                    chapter, chapter.title()))
+                self.new_tag(chapter + "-section-phantom")
+            f.write("\\end{itemize}\n")
+        with open(os.path.join(self.out_dir, "Makefile"), "w") as f:
+            f.write("LIJST = " + " \\\n\t".join(self.chapters) + "\n\n")
+            f.write("all:\n")
+        for index, chapter in enumerate(self.chapters):
+            with open(os.path.join(self.out_dir, chapter + ".tex"), "w") as f:
+                f.write(self.chapter(index))
+        with open(os.path.join(self.out_dir, "tags", "tags"), "w") as f:
+            f.write("# Synthetic tags, written by bench/gen_corpus.py\n")
+            for tag, label in self.tags:
+                f.write("{},{}\n".format(tag, label))
+
+def generate(out_dir, chapters=20, sections=40, seed=0):
+    Corpus(out_dir, chapters, sections, seed).write()
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    arg_parser.add_argument("out_dir")
+    arg_parser.add_argument("--chapters", type=int, default=20)
+    arg_parser.add_argument("--sections", type=int, default=40)
+    arg_parser.add_argument("--seed", type=int, default=0)
+    args = arg_parser.parse_args()
+    generate(args.out_dir, args.chapters, args.sections, args.seed)
+    size = sum(os.path.getsize(os.path.join(args.out_dir, name + ".tex"))
+               for name in ["chapter-{}".format(c)
+                            for c in range(1, args.chapters+1)])
+    print("{} chapters, {:.1f} MB of TeX in {}".format(
+        args.chapters, size/1e6, args.out_dir))
+
+if __name__ == "__main__":
+    main()
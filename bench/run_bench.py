@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+"""
+Converter throughput on a synthetic corpus, with a regression gate.
+
+Generates a corpus with gen_corpus.py (or uses --corpus), then measures
+in a fresh interpreter for each regex backend, the regex module and the
+standard library re, best of --repeat:
+
+  parse  Parser.parse of every chapter, MB/s of TeX source
+  link   link resolution of every division, MB/s of division bodies
+  write  rendering and writing every page, MB/s of pages
+
+Nothing is written outside a temporary directory.  --save-baseline
+stores the results as JSON; --baseline compares against such a file and
+exits with status 1 if any figure is more than --tolerance below it.
+
+    python bench/run_bench.py [--chapters 20] [--sections 40]
+        [--backend regex --backend re] [--save-baseline FILE]
+        [--baseline FILE] [--tolerance 0.15]
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+LIB_DIR = os.path.join(os.path.dirname(BENCH_DIR), "lib")
+sys.path.insert(0, BENCH_DIR)
+
+import gen_corpus
+
+BACKENDS = ("regex", "re")
+PHASES = ("parse", "link", "write")
+
+def best_of(repeat, func):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        size = func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return size/best/1e6
+
+def measure(backend, corpus, repeat):
+    # Runs with STACKS_PROJECT_DIR pointing at the corpus.
+    if backend == "re":
+        sys.modules["regex"] = None
+    sys.path.insert(0, LIB_DIR)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        import stacks_project_info
+        stacks_project_info.cache_file = os.path.join(tmp_dir, "info.cache")
+        import proc_stacks_chapter
+        from proc_stacks_chapter import Parser
+        assert proc_stacks_chapter.re.__name__ == backend
+        proc_stacks_chapter.PROJECT_DIR = tmp_dir
+        os.mkdir(os.path.join(tmp_dir, "web"))
+        chapters = stacks_project_info.chapters
+        parsers = []
+        def parse():
+            del parsers[:]
+            size = 0
+            for chapter in chapters:
+                parser = Parser(chapter)
+                parser.parse()
+                parsers.append(parser)
+                size += os.path.getsize(parser.in_file_name)
+            return size
+        linked = {}
+        def link():
+            size = 0
+            for parser in parsers:
+                linked[parser] = [ (division, parser._fix_tag_links(
+                                       parser.chapter_name, division, body))
+                                   for division, body in enumerate(parser.bodies)
+                                   if division > 0 ]
+                size += sum(len(body) for body in parser.bodies[1:])
+            return size
+        def write():
+            size = 0
+            for parser in parsers:
+                pages = [(0, parser.bodies[0])] + linked[parser]
+                for division, body in pages:
+                    nxt, prv, hme = parser._get_next_prev_home(
+                        parser.chapter_name, division)
+                    page = parser._render_html_page(body, nxt, prv, hme, division)
+                    parser.write_page(parser.out_file_name(division), page)
+                    size += len(page)
+            return size
+        results = dict(parse=best_of(repeat, parse))
+        results["link"] = best_of(repeat, link)
+        results["write"] = best_of(repeat, write)
+        return results
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def run_measure(backend, corpus, repeat):
+    env = dict(os.environ, STACKS_PROJECT_DIR=corpus)
+    output = subprocess.check_output([
+        sys.executable, os.path.realpath(__file__),
+        "--measure", backend, corpus, "--repeat", str(repeat)], env=env)
+    return json.loads(output.decode().splitlines()[-1])
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for backend, phases in results.items():
+        for phase, rate in phases.items():
+            base = baseline.get(backend, {}).get(phase)
+            if base is not None and rate < base*(1-tolerance):
+                regressions.append("{} {}: {:.2f} MB/s, baseline {:.2f} MB/s"
+                                   .format(backend, phase, rate, base))
+    return regressions
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__.strip().split("\n")[0])
+    arg_parser.add_argument("--corpus")
+    arg_parser.add_argument("--chapters", type=int, default=20)
+    arg_parser.add_argument("--sections", type=int, default=40)
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument("--repeat", type=int, default=3)
+    arg_parser.add_argument("--backend", action="append", choices=BACKENDS)
+    arg_parser.add_argument("--baseline")
+    arg_parser.add_argument("--save-baseline")
+    arg_parser.add_argument("--tolerance", type=float, default=0.15)
+    arg_parser.add_argument("--measure", nargs=2, help=argparse.SUPPRESS)
+    args = arg_parser.parse_args()
+    if args.measure:
+        backend, corpus = args.measure
+        print(json.dumps(measure(backend, corpus, args.repeat)))
+        return
+    tmp_dir = None
+    corpus = args.corpus
+    if corpus is None:
+        tmp_dir = tempfile.mkdtemp()
+        corpus = tmp_dir
+        gen_corpus.generate(corpus, args.chapters, args.sections, args.seed)
+    try:
+        size = sum(os.path.getsize(os.path.join(corpus, name))
+                   for name in os.listdir(corpus) if name.endswith(".tex"))
+        print("corpus: {:.1f} MB of TeX in {}".format(size/1e6, corpus))
+        print("{:8} ".format("backend") +
+              " ".join("{:>12}".format(phase + " MB/s") for phase in PHASES))
+        results = {}
+        for backend in args.backend or BACKENDS:
+            results[backend] = run_measure(backend, corpus, args.repeat)
+            print("{:8} ".format(backend) + " ".join(
+                "{:>12.2f}".format(results[backend][phase]) for phase in PHASES))
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=1, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("regressions of more than {:.0%}:".format(args.tolerance))
+            for regression in regressions:
+                print("    " + regression)
+            sys.exit(1)
+        print("no regressions against " + args.baseline)
+
+if __name__ == "__main__":
+    main()
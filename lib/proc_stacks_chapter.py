@@ -2,18 +2,40 @@
 
 from __future__ import print_function
 
+import array
 import collections
+import csv
 import glob
+import gzip
+import hashlib
 import json
+import marshal
+import multiprocessing
+import multiprocessing.pool
 import os
-import shutil
+import queue
+import sqlite3
 import sys
+import threading
+import time
+import zlib
+from html import unescape
 
 try:
     import regex as re
 except ImportError:
     import re
 
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 import stacks_project_info
 
 #######################################################################
@@ -26,74 +48,1700 @@ PROJECT_DIR = os.path.dirname(
                   __file__
               )))
 
-STACKS_DIR = os.path.join(
-                os.path.dirname(os.path.realpath(__file__)),
-                "stacks-project"
-                )
+STACKS_DIR = stacks_project_info.stacks_dir
+
+TAGS_FILE = os.path.join(STACKS_DIR, "tags", "tags")
+
+def file_hash(*paths):
+    digest = hashlib.sha1()
+    for path in paths:
+        with open(path, "rb") as file_obj:
+            digest.update(file_obj.read())
+    return digest.hexdigest()
+
+def peak_rss(children=False):
+    # Peak resident memory in bytes of this process, or of the largest of
+    # its finished child processes; None where it cannot be told.
+    if resource is None:
+        return None
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS.
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(who).ru_maxrss*scale
+
+def current_rss():
+    # Resident memory in bytes of this process now; None where it cannot
+    # be told (without /proc).
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1])*os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError):
+        return None
 
 #######################################################################
 # 
 #######################################################################
 
+class TagRecord(object):
+
+    __slots__ = ("number", "chapter", "division", "title")
+
+    def __init__(self, number, chapter, division, title):
+        self.number = number
+        self.chapter = sys.intern(chapter)
+        self.division = division
+        self.title = title
+
+    def __iter__(self):
+        return iter((self.number, self.chapter, self.division, self.title))
+
+    def __reduce__(self):
+        return TagRecord, tuple(self)
+
 class TagCacheClass(object):
 
+    # The tag index is an SQLite database, so that single chapter runs
+    # can open it and look tags up one by one instead of loading the
+    # whole book.  Bump the version whenever the schema changes.
+    version = 1
+
+    schema = """
+        CREATE TABLE chapters (
+            id INTEGER PRIMARY KEY,
+            name TEXT UNIQUE NOT NULL,
+            divisions INTEGER NOT NULL
+        );
+        CREATE TABLE tags (
+            tag TEXT PRIMARY KEY,
+            number,
+            chapter INTEGER NOT NULL REFERENCES chapters(id),
+            division INTEGER NOT NULL,
+            title TEXT NOT NULL
+        ) WITHOUT ROWID;
+        CREATE INDEX tags_chapter ON tags (chapter);
+        CREATE TABLE tag_children (
+            parent TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            child TEXT NOT NULL,
+            PRIMARY KEY (parent, position)
+        ) WITHOUT ROWID;
+    """
+
     def __init__(self):
         self.tags = {}
         self.tag_children = collections.defaultdict(list)
         self.chapter_divisions = collections.defaultdict(lambda:1)
-        self.tag_cache_file = os.path.join(PROJECT_DIR, "web", "tag_cache.json")
+        self.tag_cache_file = os.path.join(PROJECT_DIR, "web", "tag_cache.sqlite")
         self._number2tag = collections.defaultdict(lambda:"undefined")
+        self.journal = None
+        self._db = None
+        # The index is also read from the linking thread of a pipelined build.
+        self._db_lock = threading.Lock()
+        self._chapter_names = {}
+        self._loaded_tags = {}
+        self._loaded_children = {}
+        self._division_tags = {}
+
+    def record(self):
+        self.journal = []
+
+    def stop_recording(self):
+        journal, self.journal = self.journal, None
+        return journal
+
+    def replay(self, journal):
+        for tag, value in journal:
+            self[tag] = value
 
     def save(self):
-        obj = dict(
-            tags=self.tags, 
-            chapter_divisions=self.chapter_divisions,
-            tag_children=self.tag_children
-        )
-        with open(self.tag_cache_file, "w") as tag_cache_file_obj:
-            json.dump(obj, tag_cache_file_obj, indent=4)
+        # After load() only the chapters parsed in this run are replaced
+        # in place; otherwise a fresh index is written and swapped in.
+        if self._db is not None:
+            self._store(self._db)
+            return
+        new_file = self.tag_cache_file + ".new"
+        if os.path.exists(new_file):
+            os.remove(new_file)
+        db = sqlite3.connect(new_file)
+        try:
+            db.executescript(self.schema)
+            db.execute("PRAGMA user_version = {}".format(self.version))
+            self._store(db)
+        finally:
+            db.close()
+        os.replace(new_file, self.tag_cache_file)
+
+    def _store(self, db):
+        touched = set(record.chapter for record in self.tags.values())
+        chapters = touched.union(self.chapter_divisions)
+        with db:
+            for name in chapters:
+                db.execute("INSERT OR IGNORE INTO chapters (name, divisions) "
+                           "VALUES (?, ?)", (name, self.chapter_divisions[name]))
+                db.execute("UPDATE chapters SET divisions = ? WHERE name = ?",
+                           (self.chapter_divisions[name], name))
+            chapter_ids = dict((name, id) for id, name
+                               in db.execute("SELECT id, name FROM chapters"))
+            for name in touched:
+                chapter_id = chapter_ids[name]
+                db.execute("DELETE FROM tag_children WHERE parent IN "
+                           "(SELECT tag FROM tags WHERE chapter = ?)", (chapter_id,))
+                db.execute("DELETE FROM tags WHERE chapter = ?", (chapter_id,))
+            db.executemany(
+                "INSERT OR REPLACE INTO tags VALUES (?, ?, ?, ?, ?)",
+                ((tag, record.number, chapter_ids[record.chapter],
+                  record.division, record.title)
+                 for tag, record in self.tags.items()))
+            for parent, children in self.tag_children.items():
+                if not children:
+                    continue
+                db.execute("DELETE FROM tag_children WHERE parent = ?", (parent,))
+                db.executemany(
+                    "INSERT INTO tag_children VALUES (?, ?, ?)",
+                    ((parent, position, child)
+                     for position, child in enumerate(children)))
 
     def load(self):
-        if os.path.exists(self.tag_cache_file):
-            with open(self.tag_cache_file, "r") as tag_cache_file_obj:
-                obj = json.load(tag_cache_file_obj)
-            self.tags.clear()
-            self.tags.update(obj.tags)
-            self.chapter_divisions.clear()
-            self.chapter_divisions.update(obj.chapter_divisions)
-            self.tag_children.clear()
-            self.tag_children.update(obj.tag_children)
+        # Only the chapter table is read here; tags and their children are
+        # fetched from the index the first time they are asked for.
+        if not os.path.exists(self.tag_cache_file):
+            return
+        db = sqlite3.connect(self.tag_cache_file, check_same_thread=False)
+        version, = db.execute("PRAGMA user_version").fetchone()
+        if version != self.version:
+            print("WARNING: Ignoring tag index with version {}".format(version))
+            db.close()
+            return
+        self._db = db
+        for chapter_id, name, divisions in db.execute(
+                "SELECT id, name, divisions FROM chapters"):
+            name = sys.intern(name)
+            self._chapter_names[chapter_id] = name
+            self.chapter_divisions[name] = divisions
+
+    def get(self, tag, default=None):
+        try:
+            return self[tag]
+        except KeyError:
+            return default
+
+    def children(self, parent):
+        if parent in self.tag_children:
+            return self.tag_children[parent]
+        if parent not in self._loaded_children:
+            children = []
+            if self._db is not None:
+                with self._db_lock:
+                    children = [ child for child, in self._db.execute(
+                        "SELECT child FROM tag_children WHERE parent = ? "
+                        "ORDER BY position", (parent,)) ]
+            self._loaded_children[parent] = children
+        return self._loaded_children[parent]
+
+    def _load_tag(self, tag):
+        if tag not in self._loaded_tags:
+            record = None
+            if self._db is not None:
+                with self._db_lock:
+                    row = self._db.execute(
+                        "SELECT number, chapter, division, title FROM tags "
+                        "WHERE tag = ?", (tag,)).fetchone()
+                if row is not None:
+                    number, chapter_id, division, title = row
+                    record = TagRecord(number, self._chapter_names[chapter_id],
+                                       division, title)
+            self._loaded_tags[tag] = record
+        return self._loaded_tags[tag]
 
     def __setitem__(self, tag, value):
         number, chapter, division, title = value
+        value = TagRecord(number, chapter, division, title)
+        if self.journal is not None:
+            self.journal.append((tag, value))
+        is_new = tag not in self.tags
         self.tags[tag] = value
         self._number2tag[number] = tag
         numbers = str(number).rsplit(".", 1)
-        if len(numbers)>1:
+        if len(numbers)>1 and is_new:
             parent = self._number2tag[numbers[0]]
             self.tag_children[parent].append(tag)
         if self.chapter_divisions[chapter] < division:
             self.chapter_divisions[chapter] = division
+        self._division_tags.pop(chapter, None)
+
+    def division_tags(self, chapter):
+        # The chapter's tag, then the tag of the first section of each of
+        # its divisions.
+        tags = self._division_tags.get(chapter)
+        if tags is None:
+            tags = [ stacks_project_info.label2tag(chapter + "-section-phantom") ]
+            for tag in self.children(tags[0]):
+                if self[tag].division == len(tags):
+                    tags.append(tag)
+            self._division_tags[chapter] = tags
+        return tags
 
     def __getitem__(self, tag):
-        return self.tags[tag]
+        try:
+            return self.tags[tag]
+        except KeyError:
+            record = self._load_tag(tag)
+            if record is None:
+                raise
+            return record
 
 tag_cache = TagCacheClass()
 
+#######################################################################
+# Build manifest
+#######################################################################
+
+class BuildManifest(object):
+
+    version = 2
+
+    def __init__(self):
+        self.chapters = {}
+        self.manifest_file = os.path.join(PROJECT_DIR, "web", "build_manifest.json")
+        # The header and footer are hashed as pages get them, with the
+        # references to static assets filled in.
+        generator = hashlib.sha1(file_hash(
+            os.path.realpath(__file__),
+            stacks_project_info.__file__,
+        ).encode("ascii"))
+        for part in Parser.get_page_parts():
+            generator.update(part.encode("utf-8"))
+        self.generator = generator.hexdigest()
+        self.tags_file = file_hash(TAGS_FILE)
+        # Pages split by another policy, named another way or with other
+        # output options all have to be rewritten.
+        self.options = dict(divisions=Parser.division_policy.spec(),
+                            layout=Parser.layout, fragments=Parser.fragments,
+                            lazy_math=Parser.lazy_math,
+                            outputs=[ b.name for b in Parser.backends ])
+        self._tex_hashes = {}
+
+    def save(self):
+        obj = dict(
+            version=self.version,
+            generator=self.generator,
+            options=self.options,
+            chapters=self.chapters
+        )
+        with open(self.manifest_file, "w") as manifest_file_obj:
+            # json.dump would go through the pure Python encoder.
+            manifest_file_obj.write(json.dumps(obj, sort_keys=True))
+
+    def load(self):
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file, "r") as manifest_file_obj:
+                obj = json.load(manifest_file_obj)
+            if (obj.get("version") == self.version and
+                    obj.get("generator") == self.generator and
+                    obj.get("options") == self.options):
+                self.chapters = obj["chapters"]
+
+    def tex_hash(self, parser):
+        if parser.chapter_name not in self._tex_hashes:
+            self._tex_hashes[parser.chapter_name] = file_hash(parser.in_file_name)
+        return self._tex_hashes[parser.chapter_name]
+
+    def nav(self, parser):
+        # Neighbouring chapters show up in the next/prev links of the first
+        # and last divisions.
+        chapters = stacks_project_info.chapters
+        index = parser.chapter_number - 1
+        prev_chapter = chapters[index-1] if index > 0 else None
+        next_chapter = chapters[index+1] if index+1 < len(chapters) else None
+        prev_file = None
+        if prev_chapter:
+            prev_file = Parser.division_file(
+                prev_chapter, tag_cache.chapter_divisions[prev_chapter])
+        return [prev_chapter, prev_file, next_chapter]
+
+    def restore(self, parser):
+        # Returns True, after restoring the chapter's tags and references,
+        # if nothing the chapter was built from has changed since the
+        # recorded build and its pages are still in place.
+        entry = self.chapters.get(parser.chapter_name)
+        if (entry is None or
+                entry["number"] != parser.chapter_number or
+                entry["tags_file"] != self.tags_file or
+                entry["tex"] != self.tex_hash(parser)):
+            return False
+        for name in entry["files"]:
+            if not os.path.exists(os.path.join(PROJECT_DIR, "web", name)):
+                return False
+        parser.tag_entries = [ (e[0], e[1:]) for e in entry["entries"] ]
+        parser.refs = set(entry["refs"])
+        return True
+
+    @staticmethod
+    def link_targets(parser):
+        # Page and number every reference of the chapter resolves to, None
+        # for tags that do not resolve.  Compared with what they were when
+        # the pages were written, not with the entries of the chapters the
+        # tags are in, which a run on just those chapters may have updated.
+        targets = {}
+        for tag in parser.refs:
+            value = tag_cache.get(tag)
+            if value is not None:
+                value = [value.number,
+                         Parser.division_file(value.chapter, value.division)]
+            targets[tag] = value
+        return targets
+
+    def needs_rewrite(self, parser):
+        entry = self.chapters[parser.chapter_name]
+        return (entry["nav"] != self.nav(parser) or
+                entry["links"] != self.link_targets(parser))
+
+    def record(self, parser):
+        self.chapters[parser.chapter_name] = dict(
+            number=parser.chapter_number,
+            tex=self.tex_hash(parser),
+            tags_file=self.tags_file,
+            divisions=tag_cache.chapter_divisions[parser.chapter_name],
+            files=[ os.path.basename(name) for name in parser.output_file_names() ],
+            nav=self.nav(parser),
+            refs=sorted(parser.refs),
+            links=self.link_targets(parser),
+            entries=[ [tag] + list(value) for tag, value in parser.tag_entries ],
+        )
+
+#######################################################################
+# Structured output
+#######################################################################
+
+class IR(object):
+    # A division body as a flat stream of tokens, in three parallel
+    # arrays: the kind of every token, the piece of the body it stands
+    # for and an argument, the element name of markup and the tag of
+    # anchors and references.  Joining the pieces gives the body back as
+    # it was, link placeholders and all, so the pages stay one backend of
+    # the stream, and text and JSON are others.  It is made by lowering
+    # the body (one pass over the HTML, no TeX), and dumps to plain values
+    # for the PrelinkCache.
+
+    TEXT, MARKUP, OPEN, CLOSE, ANCHOR, MATH, DISPLAY, REF = range(8)
+    # Math may hold references, whose placeholders may hold a $.
+    token_regex = re.compile(
+        r"([^<$\x01]+)"
+        r"|(<div class='tag'><a href='[^']*'>([^<]*)</a></div>)"
+        r"|(\x01[^\n]([^\n]{4})(?:\x03[^\x03]*\x03)?)"
+        r"|(\$\$[^$\x01]*(?:(?:\x01[^\n]{5}|\$(?!\$))[^$\x01]*)*\$\$)"
+        r"|(\$[^$\x01]*(?:\x01[^\n]{5}[^$\x01]*)*\$)"
+        r"|(<(/?)(\w+)[^>]*>)"
+        r"|(.)", re.S)
+    # Kind of the token for each match.lastindex of token_regex, and the
+    # group holding its argument.
+    token_kinds = { 1: (TEXT, None), 2: (ANCHOR, 3), 4: (REF, 5),
+                    6: (DISPLAY, None), 7: (MATH, None), 8: (OPEN, 10),
+                    11: (TEXT, None) }
+    # Elements that are never closed, and elements that start a line of
+    # text.
+    void_elements = frozenset(["p", "br", "hr", "img", "link", "meta"])
+    block_elements = frozenset(["p", "br", "div", "details", "summary", "ol",
+                                "ul", "li", "pre", "h1", "h2", "h3"])
+    id_regex = re.compile(r"\sid='([^']*)'")
+    class_regex = re.compile(r"\sclass='([^']*)'")
+    markup_regex = re.compile(r"<[^>]*>")
+    space_regex = re.compile(r"[ \t]+")
+    blank_regex = re.compile(r" ?\n\s*\n\s*")
+
+    __slots__ = ("kinds", "values", "args")
+
+    def __init__(self, kinds, values, args):
+        self.kinds = kinds
+        self.values = values
+        self.args = args
+
+    @classmethod
+    def lower(cls, body):
+        kinds = array.array("B")
+        values = []
+        args = []
+        add_kind, add_value, add_arg = kinds.append, values.append, args.append
+        token_kinds = cls.token_kinds
+        void_elements = cls.void_elements
+        TEXT, OPEN = cls.TEXT, cls.OPEN
+        for match in cls.token_regex.finditer(body):
+            kind, arg_group = token_kinds[match.lastindex]
+            add_value(match.group())
+            if kind == TEXT:
+                add_kind(TEXT)
+                add_arg(None)
+                continue
+            arg = match.group(arg_group) if arg_group else None
+            if kind == OPEN:
+                if match.group(9):
+                    kind = cls.CLOSE
+                elif arg in void_elements:
+                    kind = cls.MARKUP
+            add_kind(kind)
+            add_arg(arg)
+        return cls(kinds, values, args)
+
+    def html(self):
+        return "".join(self.values)
+
+    def dump(self):
+        return [self.kinds.tobytes(), self.values, self.args]
+
+    @classmethod
+    def load(cls, obj):
+        kinds = array.array("B")
+        kinds.frombytes(obj[0])
+        return cls(kinds, obj[1], obj[2])
+
+    def spans(self):
+        # (tag, start, end) for every element with an id that is a tag,
+        # end being the index of the token after it.  List items are
+        # closed by the next item or their list.
+        spans = []
+        stack = []
+        for index, kind in enumerate(self.kinds):
+            if kind == self.OPEN:
+                name = self.args[index]
+                if name == "li" and stack and stack[-1][0] == "li":
+                    self._close(stack.pop(), index, spans)
+                value = self.values[index]
+                tag = None
+                if " id='" in value:
+                    tag = self.id_regex.search(value).group(1)
+                stack.append((name, tag, index))
+            elif kind == self.CLOSE:
+                name = self.args[index]
+                if any(entry[0] == name for entry in stack):
+                    while stack[-1][0] != name:
+                        self._close(stack.pop(), index, spans)
+                    self._close(stack.pop(), index + 1, spans)
+        while stack:
+            self._close(stack.pop(), len(self.kinds), spans)
+        spans.sort(key=lambda span: span[1])
+        return spans
+
+    @staticmethod
+    def _close(entry, end, spans):
+        name, tag, start = entry
+        if tag is not None and tag_cache.get(tag) is not None:
+            spans.append((tag, start, end))
+
+    def element_type(self, index):
+        # "section", "lemma", "equation", "item" and so on, from the class
+        # of the element that starts at index.
+        classes = self.class_regex.search(self.values[index])
+        if classes is None:
+            return self.args[index]
+        classes = classes.group(1).split()
+        if classes[0] == "thm" and len(classes) > 1:
+            return classes[1]
+        return classes[0]
+
+    def text(self, parser, start=0, end=None):
+        # Plain text of the tokens from start to end: tag anchors are
+        # dropped, block elements start new lines and other elements are
+        # set off by spaces, math is kept as TeX and references become
+        # their numbers or texts.
+        pieces = []
+        block_elements = self.block_elements
+        for kind, value, arg in zip(self.kinds[start:end], self.values[start:end],
+                                    self.args[start:end]):
+            if kind == self.ANCHOR:
+                continue
+            if kind in (self.OPEN, self.CLOSE, self.MARKUP):
+                if arg in block_elements:
+                    pieces.append("\n")
+                elif kind == self.CLOSE:
+                    pieces.append(" ")
+                continue
+            pieces.append(value)
+        text = parser._fix_tag_links(parser.chapter_name, None, "".join(pieces))
+        text = unescape(self.markup_regex.sub("", text))
+        text = self.space_regex.sub(" ", text)
+        return self.blank_regex.sub("\n\n", text).strip() + "\n"
+
+class TextBackend(object):
+    # Plain text of every page in <page>.txt, for search indexing.
+
+    name = "text"
+
+    @staticmethod
+    def text_file(file_name):
+        return file_name[:-len(".html")] + ".txt"
+
+    @classmethod
+    def patterns(cls, chapter, page_patterns):
+        return [ cls.text_file(pattern) for pattern in page_patterns ]
+
+    def file_names(self, parser):
+        return [ self.text_file(name) for name in parser.out_file_names() ]
+
+    def write(self, parser):
+        for division, ir in enumerate(parser.irs):
+            parser.write_file(self.text_file(parser.out_file_name(division)),
+                              ir.text(parser).encode("utf-8"))
+
+class JSONBackend(object):
+    # Every tag of a chapter with its number, type, title and page, and
+    # for all but sections and subsections the HTML of its element, with
+    # links that work from any page, and its text, in <chapter>.json.
+
+    name = "json"
+    version = 1
+    outline_types = ("section", "subsection")
+
+    @classmethod
+    def patterns(cls, chapter, page_patterns):
+        return [ chapter + ".json" ]
+
+    def json_file(self, chapter):
+        return os.path.join(PROJECT_DIR, "web", chapter + ".json")
+
+    def file_names(self, parser):
+        return [ self.json_file(parser.chapter_name) ]
+
+    def write(self, parser):
+        tags = []
+        for division, ir in enumerate(parser.irs):
+            for tag, start, end in ir.spans():
+                record = tag_cache[tag]
+                element_type = ir.element_type(start)
+                entry = collections.OrderedDict((
+                    ("tag", tag),
+                    ("type", element_type),
+                    ("number", record.number),
+                    ("title", record.title),
+                    ("page", parser.division_file(record.chapter,
+                                                  record.division)),
+                    ("html", None),
+                    ("text", None),
+                ))
+                if element_type not in self.outline_types:
+                    entry["html"] = parser._fix_tag_links(
+                        parser.chapter_name, None, "".join(ir.values[start:end]))
+                    entry["text"] = ir.text(parser, start, end)
+                tags.append(entry)
+        obj = collections.OrderedDict((
+            ("version", self.version),
+            ("chapter", parser.chapter_name),
+            ("number", parser.chapter_number),
+            ("title", parser.chapter_title),
+            ("tags", tags),
+        ))
+        parser.write_file(self.json_file(parser.chapter_name),
+                          json.dumps(obj).encode("utf-8"))
+
+class TagPageBackend(object):
+    # A page of its own, tag_<TAG>.html, for every section, subsection,
+    # environment and equation, with its element and a link to it in
+    # context.  Tag badges point at these when they are written.  Pages
+    # of tags that are gone are removed by TagMap.
+
+    name = "tag-pages"
+
+    @classmethod
+    def patterns(cls, chapter, page_patterns):
+        return []
+
+    def file_names(self, parser):
+        return [ TagMap.page_path(tag) for tag, value in parser.tag_entries
+                 if TagMap.has_page(tuple(value)[0]) ]
+
+    def write(self, parser):
+        pages = []
+        for ir in parser.irs:
+            for tag, start, end in ir.spans():
+                record = tag_cache[tag]
+                if TagMap.has_page(record.number):
+                    pages.append((TagMap.page_path(tag), parser.render_tag_page(
+                        tag, record, ir.element_type(start),
+                        "".join(ir.values[start:end]))))
+        TagMap.write_all(Parser.write_page, pages)
+
+output_backends = collections.OrderedDict(
+    (backend.name, backend) for backend
+    in (TextBackend, JSONBackend, TagPageBackend))
+
+#######################################################################
+# Tag lookup
+#######################################################################
+
+class TagMap(object):
+    # Where every tag of the book is, <page>#<tag>, for resolving tags
+    # without the Stacks Project site: web/tag_map.conf is the body of an
+    # nginx map from tags to locations, to be used like
+    #
+    #     map $tag $tag_location { include .../web/tag_map.conf; }
+    #     location ~ "^/tag/(?<tag>[0-9A-Z]{4})$" {
+    #         if ($tag_location) { return 301 $tag_location; }
+    #     }
+    #
+    # with locations under prefix (--tag-map-prefix, "/" unless the book is
+    # served under a subpath), and web/tags/<first three characters>.json
+    # are JSON objects from tags to locations relative to web/, so that a script finds any tag by fetching one
+    # small file.  Only whole book builds write them.  Files are written
+    # by a pool of threads.
+
+    shard_length = 3
+    # Where web/ is served, for the locations of the nginx map.
+    prefix = "/"
+    page_tmpl = "tag_{}.html"
+    page_regex = re.compile(r"tag_([0-9A-Z]{4})\.html$")
+
+    @staticmethod
+    def has_page(number):
+        # Sections, subsections, environments and equations have dotted
+        # numbers; chapters, parts and items do not.
+        return isinstance(number, str) and "." in number
+
+    @classmethod
+    def page_path(cls, tag):
+        return os.path.join(PROJECT_DIR, "web", cls.page_tmpl.format(tag))
+
+    @staticmethod
+    def write_all(write, files):
+        pool = multiprocessing.pool.ThreadPool(Parser.writers)
+        try:
+            pool.map(lambda item: write(*item), files)
+        finally:
+            pool.close()
+            pool.join()
+
+    def locations(self):
+        locations = {}
+        for tag, record in tag_cache.tags.items():
+            if record.chapter:
+                locations[tag] = "{}#{}".format(
+                    Parser.division_file(record.chapter, record.division), tag)
+        return locations
+
+    def write(self):
+        web = os.path.join(PROJECT_DIR, "web")
+        locations = self.locations()
+        prefix = self.prefix.rstrip("/") + "/"
+        lines = [ "{} {}{};\n".format(tag, prefix, locations[tag])
+                  for tag in sorted(locations) ]
+        files = [ (os.path.join(web, "tag_map.conf"),
+                   "".join(lines).encode("ascii")) ]
+        shards = collections.defaultdict(dict)
+        for tag, location in locations.items():
+            shards[tag[:self.shard_length]][tag] = location
+        shard_dir = os.path.join(web, "tags")
+        if not os.path.isdir(shard_dir):
+            os.mkdir(shard_dir)
+        for prefix, shard in shards.items():
+            files.append((os.path.join(shard_dir, prefix + ".json"),
+                          json.dumps(shard, sort_keys=True,
+                                     separators=(",", ":")).encode("ascii")))
+        self.write_all(Parser.write_file, files)
+        self.remove_stale(shard_dir, shards, locations)
+        print("tag map: {} tags in {} shards".format(len(locations), len(shards)))
+
+    def remove_stale(self, shard_dir, shards, locations):
+        # Shards of prefixes without tags, and tag pages of tags that are
+        # gone, or all of them when no tag pages are written.
+        stale = [ os.path.join(shard_dir, name) for name in os.listdir(shard_dir)
+                  if name.endswith(".json") and
+                     name[:-len(".json")] not in shards ]
+        for name in os.listdir(os.path.join(PROJECT_DIR, "web")):
+            match = self.page_regex.match(name)
+            if match and (not Parser.tag_pages or
+                          match.group(1) not in locations or
+                          not self.has_page(tag_cache[match.group(1)].number)):
+                stale.append(self.page_path(match.group(1)))
+        for old_file in stale:
+            for path in (old_file, old_file + ".gz", old_file + ".br"):
+                if os.path.exists(path):
+                    Parser.remove_output(path)
+
+#######################################################################
+# Pre-link cache
+#######################################################################
+
+class PrelinkCache(object):
+    # Division bodies of every chapter as they come out of the parser, with
+    # the link placeholders still in them, kept in .cache/prelink/ so that
+    # pages can be linked and wrapped again without parsing any TeX.  It is
+    # outside web/ so that it is never deployed with the site.  A
+    # chapter's entry holds as long as its source, its number, the tags
+    # file, this script and the options that change bodies do.  For every
+    # page it also keeps a signature of what linking and wrapping it
+    # depends on besides the body (see Parser.page_signature), so that
+    # relinking only renders the pages whose signature changed.  Builds
+    # that stream chapters a division at a time (--low-memory) neither
+    # keep nor use the cache, which would hold whole chapters.
+
+    version = 2
+    placeholder_regex = re.compile("\x01[^\n]([^\n]{4})")
+
+    def __init__(self, manifest):
+        self.cache_dir = os.path.join(PROJECT_DIR, ".cache", "prelink")
+        self.enabled = not Parser.low_memory
+        self.manifest = manifest
+        self.code = file_hash(os.path.realpath(__file__),
+                              stacks_project_info.__file__)
+        self.options = [Parser.division_policy.spec(), Parser.lazy_math]
+        # Header, footer and page options; pages are all rendered again
+        # when these changed.
+        options = dict(manifest.options)
+        del options["outputs"]
+        self.pages = hashlib.sha1(json.dumps(
+            [manifest.generator, options], sort_keys=True)
+            .encode("ascii")).hexdigest()
+
+    def _path(self, parser):
+        return os.path.join(self.cache_dir, parser.chapter_name + ".marshal")
+
+    def key(self, parser):
+        return [self.version, self.code, self.options,
+                self.manifest.tex_hash(parser), parser.chapter_number,
+                self.manifest.tags_file]
+
+    def restore(self, parser):
+        # Returns True, after restoring the state of the chapter's parser
+        # that writing its pages needs, bodies (or their IR) included, if
+        # the chapter has an entry that still holds.  The table of contents
+        # is left to relink_files.
+        if not self.enabled:
+            return False
+        try:
+            with open(self._path(parser), "rb") as cache_file:
+                entry = marshal.loads(cache_file.read())
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return False
+        if entry.get("key") != self.key(parser):
+            return False
+        parser.chapter_title = entry["chapter_title"]
+        if "irs" in entry:
+            parser.irs = [None] + [ IR.load(obj) for obj in entry["irs"] ]
+            parser.bodies = [None] + [ ir.html() for ir in parser.irs[1:] ]
+        else:
+            parser.bodies = [None] + entry["bodies"]
+        parser.division_first_section = entry["division_first_section"]
+        parser.division_last_section = entry["division_last_section"]
+        parser.division_sizes = entry["division_sizes"]
+        parser.tag_entries = [ (e[0], TagRecord(*e[1:]))
+                               for e in entry["entries"] ]
+        parser.refs = set(entry["refs"])
+        parser.untagged = set(entry["untagged"])
+        parser.division_refs = entry["division_refs"]
+        parser.signatures = entry["signatures"]
+        if entry["pages"] != self.pages:
+            parser.signatures = [None] * len(parser.signatures)
+        return True
+
+    def save(self, parser):
+        # Called once the chapter's pages are written, with the tag index
+        # they were linked against.
+        if not self.enabled:
+            return
+        if parser.division_refs is None:
+            parser.division_refs = [
+                sorted(set(self.placeholder_regex.findall(body)))
+                for body in parser.bodies ]
+        signatures = [ parser.page_signature(division)
+                       for division in range(len(parser.bodies)) ]
+        if (signatures == parser.signatures and not parser.lowered and
+                os.path.exists(self._path(parser))):
+            return
+        parser.signatures = signatures
+        entry = dict(
+            key=self.key(parser),
+            pages=self.pages,
+            chapter_title=parser.chapter_title,
+            division_first_section=parser.division_first_section,
+            division_last_section=parser.division_last_section,
+            division_sizes=parser.division_sizes,
+            entries=[ [tag] + list(value) for tag, value in parser.tag_entries ],
+            refs=sorted(parser.refs),
+            untagged=sorted(parser.untagged),
+            division_refs=parser.division_refs,
+            signatures=signatures,
+        )
+        if parser.irs is not None:
+            entry["irs"] = [ ir.dump() for ir in parser.irs[1:] ]
+        else:
+            entry["bodies"] = parser.bodies[1:]
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        path = self._path(parser)
+        with open(path + ".new", "wb") as cache_file:
+            cache_file.write(marshal.dumps(entry))
+        os.replace(path + ".new", path)
+
+#######################################################################
+# Deploy manifest
+#######################################################################
+
+def write_if_changed(file_name, data):
+    # Writes the bytes data to file_name through a temporary file renamed
+    # over it, so readers never see a partial page, unless the file holds
+    # them already, in which case it is left alone, mtime and all.
+    # Returns "added", "changed" or None.
+    try:
+        same_size = os.path.getsize(file_name) == len(data)
+    except OSError:
+        status = "added"
+    else:
+        if same_size:
+            with open(file_name, "rb") as old_file:
+                if old_file.read() == data:
+                    return None
+        status = "changed"
+    new_file = file_name + ".new"
+    with open(new_file, "wb") as new_file_obj:
+        new_file_obj.write(data)
+    os.replace(new_file, file_name)
+    return status
+
+class DeployManifest(object):
+    # Paths under web/ that a build added, changed and removed, with the
+    # SHA-1 of the new contents, saved to web/deploy_manifest.json so a
+    # deploy can push only those.  Pages are recorded from every writer
+    # thread of a pipelined build.  Build metadata (manifests, report and
+    # tag index) is left out.
+
+    version = 1
+
+    def __init__(self):
+        self.deploy_file = os.path.join(PROJECT_DIR, "web", "deploy_manifest.json")
+        self.paths = dict(added={}, changed={}, removed=[])
+        self.unchanged = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _path(file_name):
+        return os.path.relpath(file_name, os.path.join(PROJECT_DIR, "web"))
+
+    def record(self, file_name, status, data):
+        with self._lock:
+            if status is None:
+                self.unchanged += 1
+            else:
+                self.paths[status][self._path(file_name)] = \
+                    hashlib.sha1(data).hexdigest()
+
+    def remove(self, file_name):
+        os.remove(file_name)
+        with self._lock:
+            self.paths["removed"].append(self._path(file_name))
+
+    def save(self):
+        obj = collections.OrderedDict((
+            ("version", self.version),
+            ("added", self.paths["added"]),
+            ("changed", self.paths["changed"]),
+            ("removed", sorted(self.paths["removed"])),
+            ("unchanged", self.unchanged),
+        ))
+        with open(self.deploy_file, "w") as deploy_file_obj:
+            deploy_file_obj.write(json.dumps(obj, indent=1, sort_keys=False))
+        print("files: {} added, {} changed, {} removed, {} unchanged".format(
+            len(self.paths["added"]), len(self.paths["changed"]),
+            len(self.paths["removed"]), self.unchanged))
+
+#######################################################################
+# Minified and compressed output
+#######################################################################
+
+minify_regex = re.compile(
+    r"(\$\$.*?\$\$|\$(?:[^$\\]|\\.)*\$"
+    r"|<(pre|script|style|textarea)\b.*?</\2>)"
+    r"|\s*(</?(?:div|p|h[1-6]|ul|ol|li|head|body|html|meta|link|title|br)\b[^>]*>)\s*"
+    r"|[ \t]*\n\s*|[ \t]{2,}", re.S)
+
+def _minify_piece(match):
+    if match.group(1) is not None:
+        return match.group(1)
+    if match.group(3) is not None:
+        return match.group(3)
+    if "\n" in match.group():
+        return "\n"
+    return " "
+
+def minify_html(page):
+    # Drops the whitespace around block level tags and shortens other runs
+    # of whitespace to one character, leaving math, <pre>, <script>,
+    # <style> and <textarea> as they are.
+    return minify_regex.sub(_minify_piece, page)
+
+class OutputCompressor(object):
+    # Minifies pages as they are written (--minify), and at the end of a
+    # build writes .gz siblings, and .br ones if the brotli module is
+    # installed, for every page, static asset and lookup file anywhere
+    # under web/ (vendored MathJax and the tag shards included) that is
+    # newer than them (--compress), for nginx's gzip_static and
+    # brotli_static.  Build metadata is left alone.  Files are compressed
+    # in a pool of threads; zlib and brotli release the GIL.  Keeps count
+    # of the bytes both save.
+
+    extensions = (".html", ".css", ".js", ".txt", ".json", ".conf")
+    skipped_dirs = (".cache",)
+    skipped_files = ("build_manifest.json", "build_report.json",
+                     "deploy_manifest.json", "rule_profile.json")
+
+    def __init__(self, minify=False, compress=False):
+        self.minify = minify
+        self.compress = compress
+        self.formats = []
+        if compress:
+            self.formats.append(("gz",
+                lambda data: gzip.compress(data, compresslevel=9, mtime=0)))
+            if brotli is not None:
+                self.formats.append(("br", brotli.compress))
+        self.minified = [0, 0]
+        self.compressed = 0
+        self.sizes = collections.OrderedDict(
+            [ ("raw", 0) ] + [ (name, 0) for name, _ in self.formats ])
+        self._lock = threading.Lock()
+
+    def minify_page(self, page):
+        minified = minify_html(page)
+        with self._lock:
+            self.minified[0] += len(page)
+            self.minified[1] += len(minified)
+        return minified
+
+    def siblings(self, file_name):
+        return [ file_name + "." + name for name, _ in self.formats ]
+
+    def compress_all(self, threads):
+        web = os.path.join(PROJECT_DIR, "web")
+        paths = []
+        for root, dirs, files in os.walk(web):
+            dirs[:] = [ name for name in dirs if name not in self.skipped_dirs ]
+            paths += [ os.path.join(root, name) for name in files
+                       if name.endswith(self.extensions) and
+                          not (root == web and name in self.skipped_files) ]
+        paths.sort()
+        pool = multiprocessing.pool.ThreadPool(threads)
+        try:
+            pool.map(self._compress, paths)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _compress(self, path):
+        mtime = os.path.getmtime(path)
+        sizes = [ ("raw", os.path.getsize(path)) ]
+        data = None
+        for name, compress in self.formats:
+            sibling = path + "." + name
+            if not os.path.exists(sibling) or os.path.getmtime(sibling) < mtime:
+                if data is None:
+                    with open(path, "rb") as file_obj:
+                        data = file_obj.read()
+                packed = compress(data)
+                status = write_if_changed(sibling, packed)
+                if Parser.deploy is not None:
+                    Parser.deploy.record(sibling, status, packed)
+                with self._lock:
+                    self.compressed += 1
+            sizes.append((name, os.path.getsize(sibling)))
+        with self._lock:
+            for name, size in sizes:
+                self.sizes[name] += size
+
+    def stats(self):
+        return collections.OrderedDict((
+            ("minified_from", self.minified[0] if self.minify else None),
+            ("minified_to", self.minified[1] if self.minify else None),
+            ("compressed_files", self.compressed if self.compress else None),
+            ("sizes", self.sizes if self.compress else None),
+        ))
+
+    def print_stats(self):
+        def percent(part, whole):
+            return 100.0*(whole - part)/whole if whole else 0.0
+        if self.minify:
+            print("minified: {:.1f} MB to {:.1f} MB of HTML ({:.0f}% saved)"
+                  .format(self.minified[0]/1e6, self.minified[1]/1e6,
+                          percent(self.minified[1], self.minified[0])))
+        if self.compress:
+            raw = self.sizes["raw"]
+            print("compressed {} files; web/ is {:.1f} MB, ".format(
+                      self.compressed, raw/1e6) +
+                  ", ".join("{:.1f} MB as .{} ({:.0f}% saved)".format(
+                      size/1e6, name, percent(size, raw))
+                      for name, size in self.sizes.items() if name != "raw"))
+
+#######################################################################
+# Static assets
+#######################################################################
+
+class StaticAssets(object):
+    # How pages refer to the files in static/.  In the "cdn" mode the
+    # header is left as it is and the makefile copies mathjax_conf.js and
+    # style.css to web/.  "fingerprint" writes them to web/ under names
+    # with a hash of their contents, which can be cached for good, and
+    # points the header at those.  "local" does the same for
+    # mathjax_conf.js, inlines style.css and the vendored reset.css in the
+    # header and loads MathJax and the xypic extension from the copies
+    # vendored in static/vendor/ (make vendor-assets), so that nothing a
+    # page needs to show comes from another origin.  Both write
+    # web/asset_manifest.json with the Cache-Control header to serve every
+    # asset with, and remove the fingerprinted copies they replace.
+
+    version = 1
+    modes = ("cdn", "fingerprint", "local")
+    immutable = "public, max-age=31536000, immutable"
+    revalidate = "no-cache"
+    static_dir = os.path.join(PROJECT_DIR, "static")
+    vendor_dir = os.path.join(PROJECT_DIR, "static", "vendor")
+    # References in _header.html and mathjax_conf.js to what is vendored.
+    mathjax_url = "https://cdnjs.cloudflare.com/ajax/libs/mathjax/2.7.9/MathJax.js"
+    reset_url = "https://cdnjs.cloudflare.com/ajax/libs/meyer-reset/2.0/reset.css"
+    contrib_url = ("https://cdn.jsdelivr.net/gh/mathjax/"
+                   "MathJax-third-party-extensions@master/legacy")
+    reference_regex = re.compile(
+        r"""<link rel=["']stylesheet["'] href=["']([^"']*)["']>"""
+        r"""|((?:src|href)=["'])([^"']*)(["'])""")
+
+    def __init__(self, mode="cdn"):
+        self.mode = mode
+        # New references for references in the header, and the contents
+        # of the stylesheets to inline instead.
+        self.urls = {}
+        self.inline = {}
+        self.assets = collections.OrderedDict()
+
+    def _read(self, *path):
+        with open(os.path.join(*path), "rb") as file_obj:
+            return file_obj.read()
+
+    def _vendored(self, name):
+        path = os.path.join(self.vendor_dir, name)
+        if not os.path.exists(path):
+            raise SystemExit("{} is missing, run make vendor-assets".format(path))
+        return path
+
+    def _write(self, name, data):
+        # Writes data to web/ under name with a fingerprint, and returns
+        # the fingerprinted name.
+        digest = hashlib.sha1(data).hexdigest()
+        base, ext = os.path.splitext(name)
+        file_name = "{}.{}{}".format(base, digest[:10], ext)
+        path = os.path.join(PROJECT_DIR, "web", file_name)
+        Parser.deploy.record(path, write_if_changed(path, data), data)
+        self.assets[name] = collections.OrderedDict((
+            ("path", file_name), ("sha1", digest), ("bytes", len(data)),
+            ("cache_control", self.immutable)))
+        self._remove_old(os.path.join(PROJECT_DIR, "web"), base + ".", ext,
+                         file_name)
+        return file_name
+
+    @staticmethod
+    def _remove_old(directory, prefix, suffix, current):
+        # Other fingerprints of the same asset in directory, with their
+        # compressed copies, or the whole tree of a vendored directory.
+        fingerprint = re.compile(re.escape(prefix) + "[0-9a-f]{10}" +
+                                 re.escape(suffix) + r"(\.gz|\.br)?$")
+        for name in os.listdir(directory):
+            if not fingerprint.match(name) or name.startswith(current):
+                continue
+            path = os.path.join(directory, name)
+            if os.path.isdir(path):
+                for root, _, files in os.walk(path, topdown=False):
+                    for file_name in files:
+                        Parser.remove_output(os.path.join(root, file_name))
+                    os.rmdir(root)
+            else:
+                Parser.remove_output(path)
+
+    def _copy_tree(self, source, name):
+        # Copies a vendored directory to web/vendor/<name>, skipping files
+        # whose copy has the same size and mtime.
+        target = os.path.join(PROJECT_DIR, "web", "vendor", name)
+        for root, _, files in os.walk(source):
+            target_root = os.path.join(target, os.path.relpath(root, source))
+            if not os.path.isdir(target_root):
+                os.makedirs(target_root)
+            for file_name in files:
+                path = os.path.join(root, file_name)
+                copy = os.path.join(target_root, file_name)
+                stat = os.stat(path)
+                if (os.path.exists(copy) and
+                        os.path.getsize(copy) == stat.st_size and
+                        os.path.getmtime(copy) == stat.st_mtime):
+                    continue
+                data = self._read(path)
+                Parser.deploy.record(copy, write_if_changed(copy, data), data)
+                os.utime(copy, (stat.st_atime, stat.st_mtime))
+        return "vendor/" + name
+
+    def install(self):
+        if self.mode == "cdn":
+            return
+        conf = self._read(self.static_dir, "mathjax_conf.js")
+        style = self._read(self.static_dir, "style.css")
+        if self.mode == "local":
+            self.inline[self.reset_url] = self._read(self._vendored("reset.css"))
+            self.inline["style.css"] = style
+            mathjax = self._vendored("mathjax")
+            # The MathJax tree is fingerprinted by its loader, which names
+            # the version.
+            digest = hashlib.sha1(self._read(mathjax, "MathJax.js")).hexdigest()
+            mathjax_dir = self._copy_tree(mathjax, "mathjax-" + digest[:10])
+            self._remove_old(os.path.join(PROJECT_DIR, "web", "vendor"),
+                             "mathjax-", "", "mathjax-" + digest[:10])
+            self.urls[self.mathjax_url] = mathjax_dir + "/MathJax.js"
+            self.assets["MathJax"] = collections.OrderedDict((
+                ("path", mathjax_dir + "/"), ("cache_control", self.immutable)))
+            contrib_dir = self._copy_tree(self._vendored("mathjax-contrib"),
+                                          "mathjax-contrib")
+            conf = conf.replace(self.contrib_url.encode("ascii"),
+                                contrib_dir.encode("ascii"))
+            self.assets["MathJax contrib"] = collections.OrderedDict((
+                ("path", contrib_dir + "/"),
+                ("cache_control", self.revalidate)))
+        else:
+            self.urls["style.css"] = self._write("style.css", style)
+        self.urls["mathjax_conf.js"] = self._write("mathjax_conf.js", conf)
+        for name in ("nav.js", "lazy_math.js"):
+            self.urls[name] = self._write(name, self._read(self.static_dir, name))
+        self.save()
+
+    def url(self, name):
+        # Where pages find a file of static/.
+        return self.urls.get(name, name)
+
+    def save(self):
+        obj = collections.OrderedDict((
+            ("version", self.version),
+            ("mode", self.mode),
+            ("assets", self.assets),
+            ("pages", collections.OrderedDict((
+                ("path", "*.html"), ("cache_control", self.revalidate)))),
+        ))
+        with open(os.path.join(PROJECT_DIR, "web", "asset_manifest.json"),
+                  "w") as manifest_file_obj:
+            manifest_file_obj.write(json.dumps(obj, indent=1))
+
+    def header(self, header):
+        def reference(match):
+            if match.group(1) is not None:
+                if match.group(1) in self.inline:
+                    return "<style>\n{}</style>".format(
+                        self.inline[match.group(1)].decode("utf-8"))
+                return match.group().replace(
+                    match.group(1), self.urls.get(match.group(1), match.group(1)))
+            url = self.urls.get(match.group(3), match.group(3))
+            return match.group(2) + url + match.group(4)
+        if self.mode == "cdn":
+            return header
+        return self.reference_regex.sub(reference, header)
+
+#######################################################################
+# Build report
+#######################################################################
+
+class BuildReport(object):
+    # Wall and CPU time of each phase of a build, and figures for each
+    # chapter it wrote, saved to web/build_report.json after every build
+    # and printed with --stats.  CPU time includes finished pool workers.
+    # Peak memory is only told for the whole build; a chapter gets what
+    # its parse added to the resident memory of the process it ran in.
+
+    version = 2
+
+    def __init__(self):
+        self.report_file = os.path.join(PROJECT_DIR, "web", "build_report.json")
+        self.settings = {}
+        self.phases = collections.OrderedDict()
+        self.chapters = collections.OrderedDict()
+        self.up_to_date = 0
+        self.output = None
+        self._phase = None
+        self._out_file_names = {}
+
+    @staticmethod
+    def _clock():
+        times = os.times()
+        return time.time(), times[0] + times[1] + times[2] + times[3]
+
+    def start(self, phase):
+        self.stop()
+        self._phase = (phase,) + self._clock()
+
+    def stop(self):
+        if self._phase is not None:
+            phase, wall, cpu = self._phase
+            now_wall, now_cpu = self._clock()
+            self.phases[phase] = dict(wall_seconds=round(now_wall - wall, 3),
+                                      cpu_seconds=round(now_cpu - cpu, 3))
+            self._phase = None
+
+    def add(self, parser, write_seconds=None):
+        # write_seconds is None when the chapter was written while it was
+        # parsed, as in the second pass of --low-memory.
+        name = parser.chapter_name
+        self.chapters[name] = collections.OrderedDict((
+            ("parse_seconds", round(parser.parse_seconds, 3)),
+            ("write_seconds", None if write_seconds is None
+                              else round(write_seconds, 3)),
+            ("divisions", tag_cache.chapter_divisions[name]),
+            ("input_bytes", os.path.getsize(parser.in_file_name)),
+            ("output_bytes", None),
+            ("tags", len(parser.tag_entries)),
+            ("unresolved", len(parser.unresolved) + len(parser.untagged)),
+            ("rss_growth", parser.rss_growth),
+            ("division_sizes", [ collections.OrderedDict((
+                    ("source_bytes", source), ("html_bytes", output),
+                    ("math", math), ("page_bytes", None)))
+                for source, output, math in parser.division_sizes ]),
+        ))
+        self._out_file_names[name] = parser.out_file_names()
+
+    def save(self):
+        self.stop()
+        # Pages are only all on disk once the build is over.
+        for name, chapter in self.chapters.items():
+            paths = self._out_file_names[name]
+            chapter["output_bytes"] = sum(os.path.getsize(path) for path in
+                                          paths if os.path.exists(path))
+            for path, size in zip(paths[1:], chapter["division_sizes"]):
+                if os.path.exists(path):
+                    size["page_bytes"] = os.path.getsize(path)
+        obj = collections.OrderedDict((
+            ("version", self.version),
+            ("settings", self.settings),
+            ("phases", self.phases),
+            ("up_to_date", self.up_to_date),
+            ("output", self.output),
+            ("peak_rss", peak_rss()),
+            ("peak_rss_workers", peak_rss(children=True)),
+            ("chapters", self.chapters),
+        ))
+        with open(self.report_file, "w") as report_file_obj:
+            report_file_obj.write(json.dumps(obj, indent=1))
+
+    def print_stats(self):
+        print("{:14} {:>9} {:>9}".format("phase", "wall s", "cpu s"))
+        for phase, times in self.phases.items():
+            print("{:14} {:>9.3f} {:>9.3f}".format(
+                phase, times["wall_seconds"], times["cpu_seconds"]))
+        print("{:24} {:>8} {:>8} {:>5} {:>9} {:>9} {:>6} {:>5} {:>8}".format(
+            "chapter", "parse s", "write s", "divs", "in KB", "out KB",
+            "tags", "unres", "RSS +MB"))
+        def number(value, fmt):
+            return "-" if value is None else fmt.format(value)
+        for name, chapter in self.chapters.items():
+            print("{:24} {:>8} {:>8} {:>5} {:>9.0f} {:>9.0f} {:>6} {:>5} {:>8}"
+                  .format(name, number(chapter["parse_seconds"], "{:.3f}"),
+                          number(chapter["write_seconds"], "{:.3f}"),
+                          chapter["divisions"], chapter["input_bytes"]/1e3,
+                          chapter["output_bytes"]/1e3, chapter["tags"],
+                          chapter["unresolved"],
+                          number(chapter["rss_growth"] and
+                                 chapter["rss_growth"]/1e6, "{:.0f}")))
+        self.print_divisions()
+
+    def print_divisions(self):
+        # Spread of the division sizes over the chapters written, to tune
+        # the division policy by.
+        sizes = [ size for chapter in self.chapters.values()
+                       for size in chapter["division_sizes"] ]
+        if not sizes:
+            return
+        print("{} divisions ({})".format(len(sizes), self.settings["divisions"]))
+        print("{:14} {:>9} {:>9} {:>9} {:>9}".format(
+            "division", "min", "median", "p90", "max"))
+        for key, name, scale in (("source_bytes", "source KB", 1e3),
+                                 ("html_bytes", "html KB", 1e3),
+                                 ("page_bytes", "page KB", 1e3),
+                                 ("math", "math", 1)):
+            values = sorted(size[key] for size in sizes
+                            if size[key] is not None)
+            if not values:
+                continue
+            print("{:14} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}".format(name,
+                  *[ values[int(q*(len(values)-1))]/scale
+                     for q in (0, 0.5, 0.9, 1) ]))
+
+#######################################################################
+# Rule profiling
+#######################################################################
+
+class RuleProfile(object):
+    # Opt-in instrumentation of the rule table (--profile-rules).  install()
+    # wraps every rule function and rebuilds the dispatch tables around the
+    # wrappers, so _parse_handler itself is untouched and a build without
+    # it pays nothing.  Each parser collects its own figures in rule_stats:
+    # for each rule key, [matches, seconds, self seconds, output chars,
+    # nested parses], where self time leaves out the rules run by the
+    # nested parses of the handler.
+
+    fields = ("rule", "line", "regex", "matches", "total_ms", "self_ms",
+              "mean_us", "output_chars", "nested_parses")
+
+    def __init__(self, parser_class):
+        self.parser_class = parser_class
+        self.functions = dict(parser_class.rules)
+        self.chapters = collections.OrderedDict()
+        self.profile_file = os.path.join(PROJECT_DIR, "web", "rule_profile")
+
+    def install(self):
+        parser_class = self.parser_class
+        for key, rule in self.functions.items():
+            parser_class.rules[key] = self._wrap(key, rule)
+        parse = parser_class.parse
+        def parse_profiled(parser, string=None):
+            if string is not None and parser.rule_stack:
+                self._stats(parser, parser.rule_stack[-1][0])[4] += 1
+            return parse(parser, string)
+        parser_class.parse = parse_profiled
+        parser_class.parse_results += ("rule_stats",)
+        parser_class.compile_regex()
+
+    @staticmethod
+    def _stats(parser, key):
+        stats = parser.rule_stats.get(key)
+        if stats is None:
+            stats = parser.rule_stats[key] = [0, 0.0, 0.0, 0, 0]
+        return stats
+
+    def _wrap(self, key, rule):
+        timer = time.perf_counter
+        def profiled(parser, *groups):
+            stack = parser.rule_stack
+            stack.append([key, 0.0])
+            start = timer()
+            try:
+                output = rule(parser, *groups)
+            finally:
+                elapsed = timer() - start
+                _, inner = stack.pop()
+            if stack:
+                stack[-1][1] += elapsed
+            stats = self._stats(parser, key)
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] += elapsed - inner
+            stats[3] += len(output or "")
+            return output
+        return profiled
+
+    def add(self, parser):
+        self.chapters[parser.chapter_name] = dict(parser.rule_stats)
+
+    def rows(self, rule_stats):
+        rows = []
+        for entry in self.parser_class.rule_table:
+            key = entry[0]
+            if key not in rule_stats:
+                continue
+            matches, seconds, self_seconds, chars, nested = rule_stats[key]
+            rows.append(collections.OrderedDict(zip(self.fields, (
+                key, self.functions[key].__code__.co_firstlineno, entry[1],
+                matches, round(1000*seconds, 3), round(1000*self_seconds, 3),
+                round(1e6*seconds/matches, 3), chars, nested))))
+        return rows
+
+    def book(self):
+        total = {}
+        for rule_stats in self.chapters.values():
+            for key, stats in rule_stats.items():
+                total[key] = [ a + b for a, b in
+                               zip(total.get(key, [0, 0.0, 0.0, 0, 0]), stats) ]
+        return total
+
+    def save(self):
+        book = self.rows(self.book())
+        chapters = collections.OrderedDict(
+            (name, self.rows(rule_stats))
+            for name, rule_stats in self.chapters.items())
+        with open(self.profile_file + ".json", "w") as json_file:
+            json_file.write(json.dumps(dict(book=book, chapters=chapters),
+                                       indent=1))
+        with open(self.profile_file + ".csv", "w") as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(("chapter",) + self.fields)
+            for name, rows in [("*", book)] + list(chapters.items()):
+                for row in rows:
+                    writer.writerow([name] + list(row.values()))
+        print("rules by self time, {} chapters (full report in {}.json, .csv):"
+              .format(len(chapters), self.profile_file))
+        print("{:>5} {:>6} {:>9} {:>10} {:>9} {:>8}  {}".format(
+            "rule", "line", "matches", "self ms", "mean us", "nested", "regex"))
+        for row in sorted(book, key=lambda row: -row["self_ms"])[:15]:
+            print("{rule:>5} {line:>6} {matches:>9} {self_ms:>10.1f} "
+                  "{mean_us:>9.2f} {nested_parses:>8}  {regex}".format(**row))
+
+#######################################################################
+# Pipelined output
+#######################################################################
+
+class WritePipeline(object):
+    # Link and write stages of the pipelined build.  Divisions put here by
+    # the parsing thread go through a bounded queue to a linking thread,
+    # which renders the pages and queues them for a pool of writer threads,
+    # so disk writes overlap the parsing of the following chapters.
+
+    def __init__(self, writers=4, depth=16):
+        self.link_queue = queue.Queue(depth)
+        self.write_queue = queue.Queue(depth)
+        self.errors = []
+        self.threads = [ threading.Thread(target=self._link) ]
+        self.threads += [ threading.Thread(target=self._write)
+                          for _ in range(writers) ]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def put(self, parser, division, body):
+        self.link_queue.put((parser, division, body))
+
+    def close(self):
+        self.link_queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.errors:
+            raise self.errors[0]
+
+    def _link(self):
+        while True:
+            item = self.link_queue.get()
+            if item is None:
+                break
+            parser, division, body = item
+            try:
+                outputs = parser.render_outputs(division, body)
+            except Exception as error:
+                self.errors.append(error)
+            else:
+                for output in outputs:
+                    self.write_queue.put(output)
+        for _ in self.threads[1:]:
+            self.write_queue.put(None)
+
+    def _write(self):
+        while True:
+            item = self.write_queue.get()
+            if item is None:
+                break
+            try:
+                Parser.write_page(*item)
+            except Exception as error:
+                self.errors.append(error)
+
+#######################################################################
+# Division splitting
+#######################################################################
+
+class DivisionPolicy(object):
+    # Decides where chapters are split into divisions, one page each.  The
+    # section rule asks split() at every \section but the first, with the
+    # size of the division so far: bytes of TeX, bytes of HTML (the body
+    # before links are resolved) and math fragments for MathJax ($...$,
+    # $$...$$ and equations).  This policy closes the division once any
+    # budget that is not None has been passed; other policies only need
+    # to provide split(), needs_output(), needs_full_parse() and spec().
+    #
+    # With bundle=N a division also ends before every section whose tag
+    # hashes to 0 modulo N, so divisions hold N sections on average and,
+    # tags being permanent, mostly keep their sections when the chapter
+    # is edited elsewhere.  Splits forced by a budget are forgotten at the
+    # next such section.  bundle=1 puts every section on its own page.
+
+    kinds = ("source", "output", "math", "bundle")
+
+    def __init__(self, source=32*1024, output=None, math=None, bundle=None):
+        self.budgets = (source, output, math)
+        self.bundle = bundle
+
+    @classmethod
+    def from_spec(cls, spec):
+        # "source=32768,output=65536,math=400,bundle=4"; kinds left out are
+        # not checked.
+        budgets = dict((kind, None) for kind in cls.kinds)
+        for item in spec.split(","):
+            kind, _, value = item.partition("=")
+            if kind not in budgets or not value.isdigit() or int(value) == 0:
+                raise ValueError("bad division budget: {!r}".format(item))
+            budgets[kind] = int(value)
+        return cls(**budgets)
+
+    def spec(self):
+        return ",".join("{}={}".format(kind, budget) for kind, budget
+                        in zip(self.kinds, self.budgets + (self.bundle,))
+                        if budget is not None)
+
+    def split(self, size, tag):
+        # tag is the tag of the section that would start the new division,
+        # None if it has none.
+        if self.bundle is not None and tag is not None:
+            if zlib.crc32(tag.encode("ascii")) % self.bundle == 0:
+                return True
+        for budget, used in zip(self.budgets, size):
+            if budget is not None and used > budget:
+                return True
+        return False
+
+    def needs_output(self):
+        # Counting the HTML size slows the parser down, so it is only done
+        # when there is a budget for it.
+        return self.budgets[1] is not None
+
+    def needs_full_parse(self):
+        # The numbering pass (Parser.number) only runs the numbering rules,
+        # so it cannot tell HTML sizes or math fragments.
+        return self.budgets[1] is not None or self.budgets[2] is not None
+
 #######################################################################
 # Parser Object
 #######################################################################
 
+def first_char(regex):
+    # The character every match of regex starts with, for the first-char
+    # lexer.  Only literal first characters are understood, possibly
+    # inside leading groups; anything else raises ValueError.
+    escapes = { "n": "\n", "t": "\t" }
+    leading = 0
+    i = 0
+    while regex.startswith("(", i):
+        if regex.startswith("(?:", i):
+            i += 3
+        elif regex.startswith("(?P<", i):
+            i = regex.index(">", i) + 1
+        elif regex.startswith("(?", i):
+            raise ValueError("unsupported group at start of rule: " + regex)
+        else:
+            i += 1
+        leading += 1
+    if regex.startswith("\\", i):
+        first = regex[i+1]
+        if first in escapes:
+            first = escapes[first]
+        elif first.isalnum():
+            raise ValueError("character class at start of rule: " + regex)
+        end = i + 2
+    elif i < len(regex) and regex[i] not in ".[^$*+?|)":
+        first = regex[i]
+        end = i + 1
+    else:
+        raise ValueError("no literal first character in rule: " + regex)
+    if regex[end:end+1] in ("?", "*", "+"):
+        raise ValueError("optional first character in rule: " + regex)
+    # No alternation may start inside the leading groups, and none of them
+    # may be optional.
+    stack = [True] * leading
+    i = end
+    while i < len(regex):
+        char = regex[i]
+        if char == "\\":
+            i += 1
+        elif char == "[":
+            i = regex.index("]", i+2)
+        elif char == "(":
+            stack.append(False)
+        elif char == ")":
+            if stack.pop() and regex[i+1:i+2] in ("?", "*", "+"):
+                raise ValueError("optional first group in rule: " + regex)
+        elif char == "|" and (not stack or stack[-1]):
+            raise ValueError("alternation at start of rule: " + regex)
+        i += 1
+    return first
+
+class LexerState(object):
+
+    # The rules active in one state of the first-char lexer: a regex that
+    # finds the next character some rule may start with, and for each such
+    # character the alternation of those rules with its dispatch table.
+
+    def __init__(self, first_char_regex, first_char_table):
+        self.first_char_regex = first_char_regex
+        self.first_char_table = first_char_table
+
 class Parser(object):
 
     regex = []
     rules = {}
+    rule_table = []
+    dispatch = []
+    lexer = "alternation"
+    low_memory = False
+    # First-char lexer states, keyed by math_mode.
+    states = {}
+    numbering_regex = None
+    numbering_dispatch = []
+    jobs = 1
+    pipeline = False
+    writers = 4
+    incremental = True
+    # With relink, pages are only linked and wrapped again from the
+    # PrelinkCache, and no TeX is parsed.
+    relink = False
+    # A RuleProfile when rules are profiled.
+    profile = None
+    # The DeployManifest of the running build.
+    deploy = None
+    # An OutputCompressor with --minify or --compress.
+    compressor = None
+    assets = StaticAssets()
+    # With fragments, every page also gets a <page>.frag.html with only its
+    # chapter div, for static/nav.js to swap in.
+    fragments = False
+    # With lazy_math, theorems, equations and proofs are left to
+    # static/lazy_math.js to typeset (lazy_class keeps MathJax off them at
+    # load) and proofs fold.
+    lazy_math = False
+    lazy_class = ""
+    # Backends of --output, which write other products than pages from the
+    # IR of the bodies.
+    backends = []
+    # Whether tag badges link to the pages of TagPageBackend.
+    tag_pages = False
+    stats = False
+    division_policy = DivisionPolicy()
+    # "numbered" pages are <chapter>-NNN.html, "tags" pages are named by
+    # the tag of their first section (see division_file).
+    layout = "numbered"
+    parse_results = ("chapter_title", "bodies", "tag_entries", "refs",
+                     "division_first_section", "division_last_section",
+                     "division_sizes", "parse_seconds", "rss_growth",
+                     "untagged")
 
     header_file_name = os.path.join(PROJECT_DIR, "static", "_header.html")
     footer_file_name = os.path.join(PROJECT_DIR, "static", "_footer.html")
+    # Contents of the header and footer files, read once per build.
+    page_parts = None
+    # Page templates.  Bodies are joined around them, not formatted into
+    # them, so they are never copied through str.format.
+    page_head_tmpl = ("<div class='chapter' id='{tag}'>{tagdiv}\n"
+                      "<div id='nav'>"
+                      "<a id='nav-next' {nxt}></a>"
+                      "<a id='nav-index' {hme}></a>"
+                      "<a id='nav-prev' {prv}></a>"
+                      "</div>\n"
+                      "<div class='pre-title'>Chapter {num}</div>\n"
+                      "<h1>{title}</h1>\n")
+    post_title_tmpl = ("<div class='post-title'>"
+                       "Sections &sect;{num}.{s0} to &sect;{num}.{s1}"
+                       "</div>\n")
+    toc_head = ("<div class='toc'>\n"
+                "<h2>Table of contents</h2>\n"
+                "<ul>\n")
+    toc_item_tmpl = ("<li>"
+                     "<a class='toc-num' href='{file}#{tag}'>&sect;{number}</a> "
+                     "<a class='toc-title' href='{file}#{tag}'>{title}</a>\n")
+    index_head = ("<div class='chapter' id='main-index'>\n"
+                  "<h1>Stacks Project</h1>\n" + toc_head)
+    index_part_tmpl = "<li class='toc-part'>{title}\n"
+    index_item_tmpl = ("<li>"
+                       "<a class='toc-num' href='{file}'>Chapter {number}</a> "
+                       "<a class='toc-title' href='{file}'>{title}</a>\n")
+    link_tmpl = "<a class='ref' href='{root}#{tag}'>{num}</a>"
+    prefetch_tmpl = "<link rel='prefetch' href='{}'>\n"
+    tag_title_tmpl = ("<div class='post-title'>Tag {tag}: {type} "
+                      "<a href='{file}#{tag}'>{number}</a></div>\n")
+    tag_page_tmpl = TagMap.page_tmpl
+    script_tmpl = "<script src='{}' defer></script>\n"
 
     def __init__(self, chapter_name):
         self.chapter_name = chapter_name
+        # Forget the division count of a previous build of this chapter.
+        tag_cache.chapter_divisions.pop(chapter_name, None)
         self.chapter_number = stacks_project_info.chapter_number(chapter_name)
         self.chapter_title = "Chapter {}".format(self.chapter_number)
         self.phase = "start"
@@ -103,11 +1751,20 @@ class Parser(object):
         self.item_number = 0
         self.footnote_number = 0
         self.division_start = 0
+        self.division_output_start = 0
+        self.division_math_start = 0
+        # HTML minus TeX bytes of the rules run so far (only counted when
+        # the division policy needs it), and math fragments.
+        self.output_delta = 0
+        self.math_fragments = 0
+        # [source, output, math] of each division but the table of contents.
+        self.division_sizes = []
+        self.source_length = 0
         self.division_number = 0 
         self.chapter_tag = self.format_with_tag(
             "{tag}\x01{tagdiv}", "section-phantom", 
             str(self.chapter_number), self.chapter_title)
-        self.chapter_tag, self.chapter_tagdiv = self.chapter_tag.split("\x01")
+        self.chapter_tag, self.chapter_tagdiv = self.chapter_tag.split("\x01", 1)
         self.division_number = 1 
         self.division_first_section = { 0:0, 1:1 }
         self.division_last_section = { 0:0 }
@@ -115,49 +1772,182 @@ class Parser(object):
         self.math_mode = False
         self.bracket_level = 0
         self.bracket_actions = {}
+        self.refs = set()
+        self.unresolved = set()
+        # Labels of \ref and \hyperref that have no tag.
+        self.untagged = set()
+        self.rule_stats = {}
+        self.rule_stack = []
+        self.parse_seconds = 0.0
+        self.rss_growth = None
+        self.rss_start = None
+        self.tag_entries = []
+        self.bodies = []
+        # Tags each division refers to, and the page signatures, of a
+        # chapter restored from the PrelinkCache.
+        self.division_refs = None
+        self.signatures = None
+        # IR of the bodies, when there are backends, and whether bodies of
+        # divisions were lowered to it in this build.
+        self.irs = None
+        self.lowered = False
         self.in_file_name = os.path.join(
                                 STACKS_DIR,
                                 chapter_name + ".tex"
                             )
-        self.out_file_tmpl = os.path.join(
-                                PROJECT_DIR,
-                                "web",
-                                chapter_name + "-{:0>3}.html"
-                             )
 
-    def _parse_handler(self, match):
+    def _parse_handler(self, match, dispatch=None):
         self.current_match = match
-        key = match.lastgroup
-        rule = self.rules[key]
-        groups = match.groups()
-        groups = [ g for g in groups if g is not None ]
-        groups = groups[1:]
-        output = rule(self, *groups)
+        rule, groups = (dispatch or self.dispatch)[match.lastindex]
+        if not groups:
+            output = rule(self)
+        elif len(groups) == 1:
+            output = rule(self, match.group(groups[0]))
+        else:
+            output = rule(self, *match.group(*groups))
         self.current_match = None
         if output is None:
             return ""
         else:
             return output
 
+    def _counting_parse_handler(self, match, dispatch=None):
+        # _parse_handler, keeping count of the output size for the division
+        # policy, when it asks for it.
+        output = self._parse_handler(match, dispatch)
+        self.output_delta += len(output) - (match.end() - match.start())
+        return output
+
+    def _handler(self):
+        if self.division_policy.needs_output():
+            return self._counting_parse_handler
+        return self._parse_handler
+
+    def _first_char_scan(self, tex_code):
+        # Yields the pieces of self.regex.sub(self._parse_handler, tex_code),
+        # but text that cannot start a match is skipped in bulk, and at each
+        # candidate position only the rules of the current lexer state
+        # starting with that character are tried, in their usual order.
+        states = self.states
+        handler = self._handler()
+        state = states[self.math_mode]
+        last = pos = 0
+        while True:
+            candidate = state.first_char_regex.search(tex_code, pos)
+            if candidate is None:
+                break
+            start = candidate.start()
+            regex, dispatch = state.first_char_table[tex_code[start]]
+            match = regex.match(tex_code, start)
+            if match is None:
+                pos = start + 1
+                continue
+            yield tex_code[last:start]
+            yield handler(match, dispatch)
+            last = pos = match.end()
+            state = states[self.math_mode]
+        yield tex_code[last:]
+
+    def _alternation_scan(self, tex_code):
+        handler = self._handler()
+        last = 0
+        for match in self.regex.finditer(tex_code):
+            yield tex_code[last:match.start()]
+            yield handler(match)
+            last = match.end()
+        yield tex_code[last:]
+
+    def _sub(self, tex_code):
+        if self.lexer == "first-char":
+            return "".join(self._first_char_scan(tex_code))
+        return self.regex.sub(self._handler(), tex_code)
+
     def parse(self, string=None):
         if string is not None:
-            tex_code = string
-            return self.regex.sub(self._parse_handler, tex_code)
+            # Nested parses end up in the output of the calling rule.
+            output_delta = self.output_delta
+            tex_code = self._sub(string)
+            self.output_delta = output_delta
+            return tex_code
         else:
-            with open(self.in_file_name, "r") as in_file:
-                tex_code = in_file.read()
-            tex_code = self._preparse(tex_code)
-            html_code = self.regex.sub(self._parse_handler, tex_code)
+            tag_cache.record()
+            tex_code = self._read_source()
+            html_code = self._sub(tex_code)
             self.bodies = html_code.split("\x02")
             toc = self.create_toc()
             self.bodies.insert(0, toc)
+            self._stop_recording()
+
+    def stream(self, consume):
+        # Parses the chapter like parse(), but hands every division to
+        # consume(division, body) as soon as the section rule closes it,
+        # instead of keeping the bodies.  The table of contents, division 0,
+        # comes last.  Links in the bodies can only be resolved this early
+        # when tag_cache already holds the whole book.
+        tag_cache.record()
+        tex_code = self._read_source()
+        if self.lexer == "first-char":
+            pieces = self._first_char_scan(tex_code)
+        else:
+            pieces = self._alternation_scan(tex_code)
+        division = 1
+        out = []
+        for piece in pieces:
+            if "\x02" in piece:
+                head, piece = piece.split("\x02")
+                out.append(head)
+                consume(division, "".join(out))
+                division += 1
+                out = []
+            out.append(piece)
+        consume(division, "".join(out))
+        consume(0, self.create_toc())
+        self._stop_recording()
+
+    def number(self):
+        # Cheap first pass of the two-pass build: only the rules that number
+        # sections, environments, equations and items are run, so every tag
+        # of the chapter gets its number and division, but no HTML is kept.
+        tag_cache.record()
+        tex_code = self._read_source()
+        if self.division_policy.needs_full_parse():
+            self._sub(tex_code)
+        else:
+            handler = self._parse_handler
+            dispatch = self.numbering_dispatch
+            for match in self.numbering_regex.finditer(tex_code):
+                handler(match, dispatch)
+        self._stop_recording()
+
+    # Every pass over the chapter (parse, stream and number) starts with
+    # _read_source and ends with _stop_recording, which time it.
+
+    def _read_source(self):
+        self.parse_start = time.time()
+        self.rss_start = current_rss()
+        with open(self.in_file_name, "r") as in_file:
+            tex_code = in_file.read()
+        tex_code = self._preparse(tex_code)
+        self.source_length = len(tex_code)
+        return tex_code
+
+    def _stop_recording(self):
+        self.division_sizes.append(self.division_size(self.source_length))
+        self.tag_entries = tag_cache.stop_recording()
+        if self.chapter_tag in tag_cache.tags:
+            chapter_entry = (self.chapter_tag, tag_cache[self.chapter_tag])
+            self.tag_entries.insert(0, chapter_entry)
+        self.parse_seconds += time.time() - self.parse_start
+        rss = current_rss()
+        if rss is not None and self.rss_start is not None:
+            self.rss_growth = rss - self.rss_start
 
     def _preparse(self, tex_code):
         title_match = re.search(r"\\title{(.*)}", tex_code)
         if title_match:
             self.chapter_title = title_match.group(1)
             self.chapter_title = self.parse(self.chapter_title)
-            tag_cache.tags[self.chapter_tag][-1] = self.chapter_title
+            tag_cache[self.chapter_tag].title = self.chapter_title
         start = re.search(r"\\label\{section-phantom\}", tex_code)
         if start:
             tex_code = tex_code[start.end():]
@@ -166,107 +1956,324 @@ class Parser(object):
             tex_code = tex_code[:end.start()]
         return tex_code
 
+    def division_size(self, offset):
+        # [source, output, math] of the current division, up to the given
+        # offset in the source.  output is None when it is not counted.
+        output = None
+        if self.division_policy.needs_output():
+            output = offset + self.output_delta - self.division_output_start
+        return [offset - self.division_start, output,
+                self.math_fragments - self.division_math_start]
+
+    def start_division(self, offset):
+        self.division_sizes.append(self.division_size(offset))
+        self.division_number += 1
+        self.division_first_section[self.division_number] = self.section_number
+        self.division_start = offset
+        self.division_output_start = offset + self.output_delta
+        self.division_math_start = self.math_fragments
+
     def create_toc(self):
-        toc = ("<div class='toc'>\n" +
-               "<h2>Table of contents</h2>\n" +
-               "<ul>\n")
-        for sect_tag in tag_cache.tag_children[self.chapter_tag]:
+        toc = [ self.toc_head ]
+        for sect_tag in tag_cache.children(self.chapter_tag):
             number, chapter, division, title = tag_cache[sect_tag]
-            file = "{}-{:0>3}.html".format(chapter, division)
-            toc += "<li>"
-            toc += "<a class='toc-num' href='{}#{}'>".format(file, sect_tag)
-            toc += "&sect;" + number + "</a> "
-            toc += "<a class='toc-title' href='{}#{}'>".format(file, sect_tag)
-            toc += title + "</a>"
-            toc += "\n"
-        toc += "</ul>\n"
-        toc += "</div>\n"
-        return toc
+            file = self.division_file(chapter, division)
+            toc.append(self.toc_item_tmpl.format(
+                file=file, tag=sect_tag, number=number, title=title))
+        toc.append("</ul>\n</div>\n")
+        return "".join(toc)
 
     def _fix_tag_links(self, chapter, division, body):
-        def aux_fix_tag_links(match):
-            mode = match.group(1)
-            tag = match.group(2)
-            try:
-                label_number, label_chapter, label_division, _ = tag_cache[tag]
-            except:
-                return "[" + tag + "]"
-            if self.chapter_name == label_chapter and division == label_division:
-                root = ""
-            else:
-                root = "{}-{:0>3}.html".format(label_chapter, label_division)
-            if mode == "a":
-                tmpl = "<a class='ref' href='{root}#{tag}'>{num}</a>"
-            else:
-                tmpl = "{num}"
-            if match.group(3) is not None:
-                label_number = match.group(3)
-            return tmpl.format(root=root, tag=tag, num=label_number)
-        return re.sub("\x01(.)(....)(?:\x03([^\x03]*)\x03)?", aux_fix_tag_links, body)
-
-
-    def _write_html_file(self, out_file_name, body, nxt, prv, hme, div):
-        title = self.chapter_title
-        with open(out_file_name, "w") as out_file:
-            with open(self.header_file_name,"r") as header_file:
-                shutil.copyfileobj(header_file, out_file)
-            if body and body[-1]!="\n":
-                body += "\n"
-            tmpl = "<div class='chapter' id='{tag}'>{tagdiv}\n"
-            tmpl += "<div id='nav'>"
-            tmpl += "<a id='nav-next' {nxt}></a>"
-            tmpl += "<a id='nav-index' {hme}></a>"
-            tmpl += "<a id='nav-prev' {prv}></a>"
-            tmpl += "</div>\n"
-            tmpl += "<div class='pre-title'>Chapter {num}</div>\n"
-            tmpl += "<h1>{title}</h1>\n"
-            if div != 0:
-                tmpl += "<div class='post-title'>"
-                tmpl += "Sections &sect;{num}.{s0} to &sect;{num}.{s1}"
-                tmpl += "</div>\n"
-            tmpl += "{body}"
-            tmpl += "</div>"
-            print(tmpl.format(
-                    tag=self.chapter_tag, tagdiv=self.chapter_tagdiv,
-                    title=title, body=body, hme=hme, nxt=nxt, prv=prv,
-                    num=self.chapter_number, 
-                    s0=self.division_first_section[div], 
-                    s1=self.division_last_section[div],
-                ), file=out_file)
-            with open(self.footer_file_name,"r") as footer_file:
-                shutil.copyfileobj(footer_file, out_file)
+        # Splices the links in place of the placeholders the ref rules emit,
+        # \x01, a mode character, the tag and an optional \x03text\x03 to
+        # show instead of the number, in one pass over the body.  Tags that
+        # are not in tag_cache are collected in self.unresolved.
+        find = body.find
+        out = []
+        last = start = 0
+        while True:
+            start = find("\x01", start)
+            if start < 0:
+                break
+            key = body[start+1:start+6]
+            if len(key) < 5 or "\n" in key:
+                start += 1
+                continue
+            end = start + 6
+            text = None
+            if body.startswith("\x03", end):
+                close = find("\x03", end+1)
+                if close >= 0:
+                    text = body[end+1:close]
+                    end = close + 1
+            out.append(body[last:start])
+            out.append(self._link(division, key[0], key[1:], text))
+            last = start = end
+        out.append(body[last:])
+        return "".join(out)
+
+    def _link(self, division, mode, tag, text):
+        record = tag_cache.get(tag)
+        if record is None:
+            self.unresolved.add(tag)
+            return "[" + tag + "]"
+        if self.chapter_name == record.chapter and division == record.division:
+            root = ""
+        else:
+            root = self.division_file(record.chapter, record.division)
+        if mode == "t":
+            if self.tag_pages and TagMap.has_page(record.number):
+                return self.tag_page_tmpl.format(tag)
+            return root + "#" + tag
+        if text is None:
+            text = record.number
+        if mode != "a":
+            return str(text)
+        return self.link_tmpl.format(root=root, tag=tag, num=text)
 
-    def _get_next_prev_home(self, chapter, division):
+
+    @classmethod
+    def get_page_parts(cls):
+        if cls.page_parts is None:
+            with open(cls.header_file_name,"r") as header_file:
+                header = header_file.read()
+            with open(cls.footer_file_name,"r") as footer_file:
+                footer = footer_file.read()
+            cls.page_parts = (cls.assets.header(header), footer)
+        return cls.page_parts
+
+    @classmethod
+    def write_page(cls, out_file_name, page):
+        if cls.compressor is not None and cls.compressor.minify:
+            page = cls.compressor.minify_page(page)
+        cls.write_file(out_file_name, page.encode("utf-8"))
+
+    @classmethod
+    def write_file(cls, out_file_name, data):
+        status = write_if_changed(out_file_name, data)
+        if cls.deploy is not None:
+            cls.deploy.record(out_file_name, status, data)
+        if status is not None and (cls.compressor is None or
+                                   not cls.compressor.compress):
+            # nginx would go on serving compressed copies of the old page.
+            for path in (out_file_name + ".gz", out_file_name + ".br"):
+                if os.path.exists(path):
+                    cls.remove_output(path)
+
+    @classmethod
+    def remove_output(cls, path):
+        if cls.deploy is not None:
+            cls.deploy.remove(path)
+        else:
+            os.remove(path)
+
+    def _render_chapter_div(self, body, nxt, prv, hme, div):
+        # The pieces of the chapter div, everything of a page between the
+        # header and the footer.
+        page = [ self.page_head_tmpl.format(
+                    tag=self.chapter_tag,
+                    tagdiv=self._fix_tag_links(self.chapter_name, div,
+                                               self.chapter_tagdiv),
+                    title=self.chapter_title, hme=hme, nxt=nxt, prv=prv,
+                    num=self.chapter_number) ]
+        if div:
+            page.append(self.post_title_tmpl.format(
+                num=self.chapter_number,
+                s0=self.division_first_section[div],
+                s1=self.division_last_section[div]))
+        page.append(body)
+        if body and body[-1]!="\n":
+            page.append("\n")
+        page.append("</div>\n")
+        return page
+
+    def _render_html_page(self, body, nxt, prv, hme, div):
+        header, footer = self.get_page_parts()
+        page = [ header ]
+        page += self._render_chapter_div(body, nxt, prv, hme, div)
+        if self.fragments:
+            for neighbour in self._next_prev_files(self.chapter_name, div):
+                if neighbour is not None:
+                    page.append(self.prefetch_tmpl.format(
+                        self.fragment_file(neighbour)))
+        for script in self.page_scripts():
+            page.append(self.script_tmpl.format(self.assets.url(script)))
+        page.append(footer)
+        return "".join(page)
+
+    def render_tag_page(self, tag, record, element_type, html):
+        # Page of a tag: the chapter's heading, a link to the tag in
+        # context and the element, with links that work from web/.
+        header, footer = self.get_page_parts()
+        page = [ header ]
+        page += self._render_chapter_div(
+            self._fix_tag_links(self.chapter_name, None, html),
+            "class='disabled'", "class='disabled'", "href='index.html'", None)
+        page.insert(2, self.tag_title_tmpl.format(
+            tag=tag, type=element_type, number=record.number,
+            file=self.division_file(record.chapter, record.division)))
+        if self.lazy_math:
+            page.append(self.script_tmpl.format(self.assets.url("lazy_math.js")))
+        page.append(footer)
+        return "".join(page)
+
+    def page_scripts(self):
+        scripts = []
+        if self.fragments:
+            scripts.append("nav.js")
+        if self.lazy_math:
+            scripts.append("lazy_math.js")
+        return scripts
+
+    def _next_prev_files(self, chapter, division):
         if division == tag_cache.chapter_divisions[chapter]:
             try:
                 next_chapter = stacks_project_info.chapters[self.chapter_number]
             except:
-                next_link = "class='disabled'"
+                next_file = None
             else:
-                next_link = "href='{}-{:0>3}.html'".format(next_chapter, 0)
+                next_file = self.division_file(next_chapter, 0)
         else:
-            next_link = "href='{}-{:0>3}.html'".format(chapter, division+1)
+            next_file = self.division_file(chapter, division+1)
         if division == 0:
             if self.chapter_number == 1:
-                prev_link = "class='disabled'"
+                prev_file = None
             else:
                 prev_chapter = stacks_project_info.chapters[self.chapter_number-2]
                 prev_division = tag_cache.chapter_divisions[prev_chapter]
-                prev_link = "href='{}-{:0>3}.html'".format(prev_chapter, prev_division)
+                prev_file = self.division_file(prev_chapter, prev_division)
         else:
-            prev_link = "href='{}-{:0>3}.html'".format(chapter, division-1)
+            prev_file = self.division_file(chapter, division-1)
+        return next_file, prev_file
+
+    def _get_next_prev_home(self, chapter, division):
+        links = []
+        for name in self._next_prev_files(chapter, division):
+            if name is None:
+                links.append("class='disabled'")
+            else:
+                links.append("href='{}'".format(name))
+        next_link, prev_link = links
         home_link = "href='index.html'"
         return next_link, prev_link, home_link
 
+    @classmethod
+    def division_file(cls, chapter, division):
+        # Name of the page of a division, relative to web/.  In the tags
+        # layout a page keeps its name as long as it starts with the same
+        # section, and the table of contents is <chapter>.html.  Divisions
+        # without a section (a chapter without any) fall back to numbers.
+        if cls.layout == "tags":
+            if division == 0:
+                return chapter + ".html"
+            tags = tag_cache.division_tags(chapter)
+            if division < len(tags):
+                return "{}-{}.html".format(chapter, tags[division])
+        return "{}-{:0>3}.html".format(chapter, division)
+
+    def out_file_name(self, division):
+        return os.path.join(PROJECT_DIR, "web",
+                            self.division_file(self.chapter_name, division))
+
+    def out_file_names(self):
+        return [ self.out_file_name(division) for division
+                 in range(tag_cache.chapter_divisions[self.chapter_name]+1) ]
+
+    @staticmethod
+    def fragment_file(file_name):
+        return file_name[:-len(".html")] + ".frag.html"
+
+    def output_file_names(self):
+        # Pages, their fragments if there are any, and what the backends
+        # write.
+        names = self.out_file_names()
+        if self.fragments:
+            names += [ self.fragment_file(name) for name in names ]
+        for backend in self.backends:
+            names += backend.file_names(self)
+        return names
+
+    def remove_stale_files(self):
+        # Pages of the chapter and their fragments, in either layout, that
+        # are not part of it any more.  Only called once the new pages are
+        # all written.
+        web = os.path.join(PROJECT_DIR, "web")
+        current = set(self.output_file_names())
+        patterns = [ self.chapter_name + "-???.html",
+                     self.chapter_name + "-" + "[0-9A-Z]"*4 + ".html",
+                     self.chapter_name + ".html" ]
+        page_patterns = patterns
+        patterns = page_patterns + [ self.fragment_file(pattern)
+                                     for pattern in page_patterns ]
+        for backend in output_backends.values():
+            patterns += backend.patterns(self.chapter_name, page_patterns)
+        for pattern in patterns:
+            for old_file in glob.glob(os.path.join(web, pattern)):
+                if old_file in current:
+                    continue
+                for path in (old_file, old_file + ".gz", old_file + ".br"):
+                    if os.path.exists(path):
+                        self.remove_output(path)
+
+    def render_outputs(self, division, body):
+        # The files to write for a division, as (path, contents) pairs.
+        if division > 0:
+            body = self._fix_tag_links(self.chapter_name, division, body)
+        nxt, prv, hme = self._get_next_prev_home(self.chapter_name, division)
+        out_file_name = self.out_file_name(division)
+        outputs = [ (out_file_name,
+                     self._render_html_page(body, nxt, prv, hme, division)) ]
+        if self.fragments:
+            outputs.append((self.fragment_file(out_file_name), "".join(
+                self._render_chapter_div(body, nxt, prv, hme, division))))
+        return outputs
+
+    def write_division(self, division, body):
+        for out_file_name, page in self.render_outputs(division, body):
+            self.write_page(out_file_name, page)
+
     def write_files(self):
-        for old_file in glob.iglob(self.out_file_tmpl.format("???")):
-            os.remove(old_file)
         for division, body in enumerate(self.bodies):
-            if division > 0:
-                body = self._fix_tag_links(self.chapter_name, division, body)
-            out_file_name = self.out_file_tmpl.format(division)
-            nxt, prv, hme = self._get_next_prev_home(self.chapter_name, division)
-            self._write_html_file(out_file_name, body, nxt, prv, hme, division)
+            self.write_division(division, body)
+
+    def write_outputs(self):
+        # Lowers the bodies that have no IR yet and hands the IR of the
+        # chapter to every backend.
+        if self.irs is None:
+            self.irs = [None] * len(self.bodies)
+        for division, body in enumerate(self.bodies):
+            if self.irs[division] is None:
+                self.irs[division] = IR.lower(body)
+                self.lowered = self.lowered or division > 0
+        for backend in self.backends:
+            backend.write(self)
+
+    def page_signature(self, division):
+        # Everything the page of a division depends on besides its cached
+        # body: the links it gets, where its tag badges point, its
+        # neighbours and, for the table of contents, which is not cached,
+        # the body itself.
+        parts = [ self._link(division, "a", tag, None)
+                  for tag in self.division_refs[division] ]
+        parts.append(str(self.tag_pages))
+        parts += [ str(name) for name
+                   in self._next_prev_files(self.chapter_name, division) ]
+        if division == 0:
+            parts.append(self.bodies[0])
+        return hashlib.sha1("\n".join(parts).encode("utf-8")).hexdigest()
+
+    def relink_files(self):
+        # Writes the pages of a chapter restored from the PrelinkCache whose
+        # signature changed or that are missing.
+        self.bodies[0] = self.create_toc()
+        for division, body in enumerate(self.bodies):
+            names = [ self.out_file_name(division) ]
+            if self.fragments:
+                names.append(self.fragment_file(names[0]))
+            if (self.page_signature(division) == self.signatures[division] and
+                    all(os.path.exists(name) for name in names)):
+                continue
+            self.write_division(division, body)
 
     def increase_bracket_level(self, action=None):
         self.bracket_level += 1
@@ -282,20 +2289,29 @@ class Parser(object):
         self.bracket_level -= 1
         return result
 
+    def tag_of(self, label):
+        try:
+            return stacks_project_info.label2tag(self.chapter_name + "-" + label)
+        except KeyError:
+            return None
+
     def format_with_tag(self, tmpl, label, number="???", title="", **kws):
         full_label = self.chapter_name + "-" + label
         try:
             tag = stacks_project_info.label2tag(full_label)
         except:
             tag = "XXXX"
+            href = "#"
             print("WARNING: Tag not found: " + full_label)
         else:
             tag_cache[tag] = [number, self.chapter_name, self.division_number,
                               title]
+            # The tag's page or location, filled in by _fix_tag_links.
+            href = "\x01t" + tag
         tagdiv = "<div class='tag'>"
-        tagdiv += "<a href='http://stacks.math.columbia.edu/tag/{tag}'>"
+        tagdiv += "<a href='{href}'>"
         tagdiv += "{tag}</a></div>"
-        tagdiv = tagdiv.format(tag=tag)
+        tagdiv = tagdiv.format(tag=tag, href=href)
         return tmpl.format(tag=tag, number=number, title=title, tagdiv=tagdiv, **kws)
 
     @classmethod
@@ -322,77 +2338,309 @@ class Parser(object):
                     part_tag = str(part_number)
                     part_number2 = roman_numbers[part_number]
                     part_title = line[:-1]
-                    tag_cache.tags[part_tag] = [part_number2, "", 0, part_title]
+                    tag_cache.tags[part_tag] = TagRecord(part_number2, "", 0,
+                                                         part_title)
                     tag_cache.tag_children[""].append(part_tag)
 
     @classmethod
     def write_complete_toc(cls):
         toc_file_path = os.path.join(PROJECT_DIR, "web", "index.html")
-        with open(toc_file_path, "w") as toc_file:
-            with open(cls.header_file_name,"r") as header_file:
-                shutil.copyfileobj(header_file, toc_file)
-            body = "<div class='chapter' id='main-index'>\n"
-            body += "<h1>Stacks Project</h1>\n"
-            body += "<div class='toc'>\n"
-            body += "<h2>Table of contents</h2>\n"
-            body += "<ul>\n"
-            for part in tag_cache.tag_children[""]:
-                part_title = tag_cache[part][-1]
-                body += "<li class='toc-part'>"
-                body += part_title + "\n"
-                for chp_tag in tag_cache.tag_children[part]:
-                    chp_number, chp_name, _, chp_title = tag_cache[chp_tag]
-                    chp_file = "{}-{:0>3}.html".format(chp_name, 0)
-                    body += "<li>"
-                    body += "<a class='toc-num' href='{}'>".format(chp_file)
-                    body += "Chapter " + chp_number + "</a> "
-                    body += "<a class='toc-title' href='{}'>".format(chp_file)
-                    body += chp_title + "</a>"
-                    body += "\n"
-            body += "</ul>\n"
-            body += "</div>\n"
-            body += "</div>\n"
-            print(body, file=toc_file)
-            with open(cls.footer_file_name,"r") as footer_file:
-                shutil.copyfileobj(footer_file, toc_file)
+        header, footer = cls.get_page_parts()
+        page = [ header, cls.index_head ]
+        for part in tag_cache.children(""):
+            page.append(cls.index_part_tmpl.format(
+                title=tag_cache[part].title))
+            for chp_tag in tag_cache.children(part):
+                chp_number, chp_name, _, chp_title = tag_cache[chp_tag]
+                chp_file = cls.division_file(chp_name, 0)
+                page.append(cls.index_item_tmpl.format(
+                    file=chp_file, number=chp_number, title=chp_title))
+        page.append("</ul>\n</div>\n</div>\n\n")
+        page.append(footer)
+        cls.write_page(toc_file_path, "".join(page))
 
     @classmethod
     def process(cls, *chapters):
         print("initializing")
+        report = BuildReport()
+        report.settings = dict(jobs=cls.jobs, lexer=cls.lexer,
+                               low_memory=cls.low_memory, pipeline=cls.pipeline,
+                               incremental=cls.incremental, relink=cls.relink,
+                               divisions=cls.division_policy.spec(),
+                               layout=cls.layout,
+                               assets=cls.assets.mode,
+                               fragments=cls.fragments,
+                               lazy_math=cls.lazy_math,
+                               outputs=[ b.name for b in cls.backends ],
+                               minify=cls.compressor is not None and
+                                      cls.compressor.minify,
+                               compress=cls.compressor is not None and
+                                        cls.compressor.compress,
+                               chapters=list(chapters))
+        report.start("initializing")
+        cls.deploy = DeployManifest()
+        cls.assets.install()
+        manifest = BuildManifest()
+        manifest.load()
+        cache = PrelinkCache(manifest)
         if not chapters:
             write_toc = True
             chapters = stacks_project_info.chapters
         else:
             write_toc = False
+        if not write_toc or cls.relink:
             tag_cache.load()
         chapter_parsers = [ cls(chapter) for chapter in chapters ]
-        for parser in chapter_parsers:
-            print("parsing chapter: " + parser.chapter_name)
-            parser.parse()
-        for parser in chapter_parsers:
-            print("writing chapter: " + parser.chapter_name)
-            parser.write_files()
+        # Chapters whose pages are written from the PrelinkCache.
+        cached = set()
+        if cls.relink:
+            missing = [ parser.chapter_name for parser in chapter_parsers
+                                            if not cache.restore(parser) ]
+            if missing:
+                raise SystemExit("No pre-link cache of the current sources of "
+                                 "{}, build without --relink".format(
+                                     ", ".join(missing)))
+            for parser in chapter_parsers:
+                tag_cache.replay(parser.tag_entries)
+            stale = chapter_parsers
+            cached.update(stale)
+        elif write_toc and cls.incremental:
+            stale = [ parser for parser in chapter_parsers
+                             if not manifest.restore(parser) ]
+            cached.update(parser for parser in stale if cache.restore(parser))
+            report.start("parse")
+            cls.parse_chapters(chapter_parsers,
+                               [ p for p in stale if p not in cached ])
+            # Up to date chapters still have to be rewritten when tags they
+            # link to have moved, or when their neighbours changed.
+            stale_set = set(stale)
+            relink = [ parser for parser in chapter_parsers
+                              if parser not in stale_set and
+                                 manifest.needs_rewrite(parser) ]
+            cached.update(parser for parser in relink if cache.restore(parser))
+            relink = [ parser for parser in relink if parser not in cached ]
+            if not cls.low_memory:
+                cls.parse_chapters(relink, relink)
+            stale_set.update(relink)
+            stale_set.update(cached)
+            stale = [ parser for parser in chapter_parsers if parser in stale_set ]
+            report.up_to_date = len(chapter_parsers) - len(stale)
+            print("up to date: {} of {} chapters, {} relinked from cache".format(
+                report.up_to_date, len(chapter_parsers), len(cached)))
+        else:
+            stale = chapter_parsers
+            report.start("parse")
+            cls.parse_chapters(chapter_parsers, stale)
+        report.start("write")
+        pipeline = None
+        if cls.pipeline:
+            pipeline = WritePipeline(cls.writers)
+        unresolved = []
+        try:
+            for parser in stale:
+                write_seconds = None
+                if parser in cached:
+                    print("relinking chapter: " + parser.chapter_name)
+                    start = time.time()
+                    parser.relink_files()
+                    write_seconds = time.time() - start
+                elif cls.low_memory:
+                    parser = cls.render(parser, pipeline)
+                else:
+                    print("writing chapter: " + parser.chapter_name)
+                    start = time.time()
+                    parser.write_files()
+                    write_seconds = time.time() - start
+                if cls.backends:
+                    parser.write_outputs()
+                manifest.record(parser)
+                cache.save(parser)
+                report.add(parser, write_seconds)
+                unresolved.append((parser.chapter_name,
+                                   parser.unresolved | parser.untagged))
+                if cls.profile is not None:
+                    cls.profile.add(parser)
+        finally:
+            if pipeline is not None:
+                pipeline.close()
+        for parser in stale:
+            parser.remove_stale_files()
+        cls.report_unresolved(unresolved)
+        if cls.profile is not None:
+            cls.profile.save()
         if write_toc:
+            report.start("toc")
             print("writing index.html")
             cls.process_chapter_list()
             cls.write_complete_toc()
+            TagMap().write()
+        if cls.compressor is not None and cls.compressor.compress:
+            report.start("compress")
+            print("compressing")
+            cls.compressor.compress_all(cls.jobs if cls.jobs > 1
+                                        else multiprocessing.cpu_count())
+        report.start("save")
         print("finishing")
         tag_cache.save()
+        manifest.save()
+        cls.deploy.save()
+        if cls.compressor is not None:
+            report.output = cls.compressor.stats()
+            cls.compressor.print_stats()
+        report.save()
+        if cls.stats:
+            report.print_stats()
+        if resource is not None:
+            print("peak memory: {:.0f} MB (largest worker: {:.0f} MB)".format(
+                peak_rss()/1e6, peak_rss(children=True)/1e6))
+
+    @staticmethod
+    def report_unresolved(unresolved):
+        unresolved = [ (chapter, tags) for chapter, tags in unresolved if tags ]
+        if unresolved:
+            print("WARNING: References to unknown tags or labels in {} "
+                  "chapters:".format(
+                len(unresolved)))
+            for chapter, tags in unresolved:
+                print("    {}: {}".format(chapter, " ".join(sorted(tags))))
+
+    @classmethod
+    def render(cls, numbered, pipeline=None):
+        # Second pass of the two-pass build: a fresh parser streams the
+        # chapter to its files one division at a time, or to the link and
+        # write stages of the pipeline.
+        print("rendering chapter: " + numbered.chapter_name)
+        parser = cls(numbered.chapter_name)
+        parser.parse_seconds = numbered.parse_seconds
+        # The bodies of the chapter are only kept for output backends.
+        bodies = {}
+        def consume(division, body):
+            if cls.backends:
+                bodies[division] = body
+            if pipeline is None:
+                parser.write_division(division, body)
+            else:
+                pipeline.put(parser, division, body)
+        parser.stream(consume)
+        parser.bodies = [ bodies[division] for division in sorted(bodies) ]
+        def locations(tag_entries):
+            return [ (tag, tuple(value)[:3]) for tag, value in tag_entries ]
+        if locations(parser.tag_entries) != locations(numbered.tag_entries):
+            print("WARNING: Numbering pass disagrees with rendering in "
+                  + parser.chapter_name)
+        return parser
+
+    @classmethod
+    def parse_chapters(cls, chapter_parsers, stale):
+        # Parses the stale chapters (only numbers them, in low memory mode)
+        # and brings tag_cache up to date with the tags of all of
+        # chapter_parsers, in chapter order.
+        stale = set(stale)
+        if cls.jobs > 1:
+            cls.parse_in_pool([ p for p in chapter_parsers if p in stale ])
+            for parser in chapter_parsers:
+                tag_cache.replay(parser.tag_entries)
+        else:
+            for parser in chapter_parsers:
+                if parser not in stale:
+                    tag_cache.replay(parser.tag_entries)
+                elif cls.low_memory:
+                    print("numbering chapter: " + parser.chapter_name)
+                    parser.number()
+                else:
+                    print("parsing chapter: " + parser.chapter_name)
+                    parser.parse()
 
     @classmethod
-    def rule(cls, regex):
+    def parse_in_pool(cls, chapter_parsers):
+        # Workers parse whole chapters and send back the parser state that
+        # write_files needs, including the tag_cache entries they recorded
+        # (tag_entries), which the caller replays in chapter order.
+        # Chapters are handed out largest first to keep the pool busy.
+        # Workers are forked so that they see the settings the command line
+        # put in class attributes; spawned ones would import the module
+        # afresh and run with the defaults.
+        if not chapter_parsers:
+            return
+        names = [ parser.chapter_name for parser in chapter_parsers ]
+        names.sort(key=lambda name: -os.path.getsize(
+                                        os.path.join(STACKS_DIR, name + ".tex")))
+        method = "number" if cls.low_memory else "parse"
+        results = {}
+        pool = multiprocessing.get_context("fork").Pool(cls.jobs)
+        try:
+            for name, state in pool.imap_unordered(
+                    _parse_chapter, [ (name, method) for name in names ]):
+                print("{}ing chapter: {}".format(method[:-1] if method == "parse"
+                                                 else method, name))
+                results[name] = state
+        finally:
+            pool.close()
+            pool.join()
+        for parser in chapter_parsers:
+            parser.__dict__.update(results[parser.chapter_name])
+
+    @classmethod
+    def rule(cls, regex, first=None, math=True, numbering=False):
+        # Rules registered with math=False are left out of the math state of
+        # the first-char lexer; they must leave math input untouched and have
+        # no other effect there.  Rules registered with numbering=True are
+        # the only ones run by the numbering pass (Parser.number).
         key = "a{}".format(len(cls.rules))
         regex = regex.replace("{", r"\{")
         regex = regex.replace("}", r"\}")
-        cls.regex.append("(?P<{}>{})".format(key, regex))
+        if first is None:
+            first = first_char(regex)
+        cls.rule_table.append(
+            (key, regex, re.compile(regex).groups, first, math, numbering))
         def decorator(transform_func):
             cls.rules[key] = transform_func
             return transform_func
         return decorator
 
+    @classmethod
+    def _dispatch_table(cls, entries):
+        # Each rule contributes its outer group followed by its own capture
+        # groups.  match.lastindex is the index of the outer group of the
+        # rule that matched, so the table maps it straight to the rule and
+        # the indices of the groups to pass on.
+        dispatch = [None]
+        for key, regex, n_groups, first, math, numbering in entries:
+            index = len(dispatch) + 1
+            dispatch.append((cls.rules[key], tuple(range(index, index+n_groups))))
+            dispatch.extend([None] * n_groups)
+        return dispatch
+
+    @classmethod
+    def _compile_state(cls, entries):
+        by_first_char = collections.OrderedDict()
+        for entry in entries:
+            by_first_char.setdefault(entry[3], []).append(entry)
+        first_char_table = {}
+        for char, char_entries in by_first_char.items():
+            char_regex = "|".join("({})".format(entry[1]) for entry in char_entries)
+            first_char_table[char] = (re.compile(char_regex),
+                                      cls._dispatch_table(char_entries))
+        first_char_regex = re.compile(
+            "[" + "".join(re.escape(char) for char in by_first_char) + "]")
+        return LexerState(first_char_regex, first_char_table)
+
+    @classmethod
+    def _compile_alternation(cls, entries):
+        return re.compile("|".join("(?P<{}>{})".format(entry[0], entry[1])
+                                   for entry in entries))
+
     @classmethod
     def compile_regex(cls):
-        cls.regex = re.compile("|".join(cls.regex))
+        cls.dispatch = cls._dispatch_table(cls.rule_table)
+        cls.regex = cls._compile_alternation(cls.rule_table)
+        numbering = [ entry for entry in cls.rule_table if entry[5] ]
+        cls.numbering_dispatch = cls._dispatch_table(numbering)
+        cls.numbering_regex = cls._compile_alternation(numbering)
+        cls.states = {
+            False: cls._compile_state(cls.rule_table),
+            True: cls._compile_state([ e for e in cls.rule_table if e[4] ]),
+        }
 
 #######################################################################
 # Parser rules
@@ -413,11 +2661,14 @@ def __(parser):
         return "$$\n"
     else:
         parser.math_mode = True
+        parser.math_fragments += 1
         return "\n$$"
 
 @Parser.rule(r"\$")
 def __(parser):
     parser.math_mode = not parser.math_mode
+    if parser.math_mode:
+        parser.math_fragments += 1
     return "$"
 
 @Parser.rule(r"{\\it\s")
@@ -504,15 +2755,14 @@ section_tmpl="""
 <h2><span class='number'>&sect;{number}</span>{title}</h2>
 """
 
-@Parser.rule(r"\\section{(.*)}\n\\label{(.*)}")
+@Parser.rule(r"\\section{(.*)}\n\\label{(.*)}", numbering=True)
 def __(parser, title, label):
     parser.math_mode = False
     if parser.section_number > 0:
         match_start = parser.current_match.start()
-        if match_start - parser.division_start > 32*1024:
-            parser.division_number += 1
-            parser.division_first_section[parser.division_number] = parser.section_number
-            parser.division_start = match_start
+        if parser.division_policy.split(parser.division_size(match_start),
+                                        parser.tag_of(label)):
+            parser.start_division(match_start)
             out = "\n</div>\n\x02"
         else:
             out = "\n</div>\n"
@@ -532,7 +2782,7 @@ subsection_tmpl="""
 <h3><span class='number'>&para;{number}</span>{title}</h3>
 """
 
-@Parser.rule(r"\\subsection{(.*)}\n\\label{(.*)}")
+@Parser.rule(r"\\subsection{(.*)}\n\\label{(.*)}", numbering=True)
 def __(parser, title, label):
     parser.math_mode = False
     parser.subsection_number += 1
@@ -554,8 +2804,10 @@ def __(parser, label):
         tag = stacks_project_info.label2tag(label)
     except:
         print("WARNING: Tag not found: " + label)
+        parser.untagged.add(label)
         return "[" + label + "]"
     else:
+        parser.refs.add(tag)
         if parser.math_mode:
             return "\x01$" + tag
         else:
@@ -571,8 +2823,10 @@ def __(parser, label, text):
         tag = stacks_project_info.label2tag(label)
     except:
         print("WARNING: Tag not found: " + label)
+        parser.untagged.add(label)
         return "[" + label + "]"
     else:
+        parser.refs.add(tag)
         return "\x01a" + tag + "\x03" + text + "\x03"
 
 cite_tmpl = "<a href='http://stacks.math.columbia.edu/bibliography/{cite}'>{cite}</a>"
@@ -600,11 +2854,11 @@ envs = "|".join([
 ])
 
 env_tmpl="""
-<div class='thm {env}' id='{tag}'>{tagdiv}
+<div class='thm {env}{lazy}' id='{tag}'>{tagdiv}
 <span class='thm-header'>{env}<span class='number'> {number}</span></span>
 """
 
-@Parser.rule(r"\\begin{(" + envs + r")}\n\\label{(.*)}")
+@Parser.rule(r"\\begin{(" + envs + r")}\n\\label{(.*)}", numbering=True)
 def __(parser, environ, label):
     parser.math_mode = False
     parser.subsection_number += 1
@@ -614,15 +2868,16 @@ def __(parser, environ, label):
         parser.section_number,
         parser.subsection_number
     )
-    return parser.format_with_tag(env_tmpl, label, number, env=environ)
+    return parser.format_with_tag(env_tmpl, label, number, env=environ,
+                                  lazy=parser.lazy_class)
 
 env_tmpl2="""
-<div class='thm {env}' id='{tag}'>{tagdiv}
+<div class='thm {env}{lazy}' id='{tag}'>{tagdiv}
 <span class='thm-header'>{env}<span class='number'> {number}</span>
 <span class='title'>{title}</span></span>
 """
 
-@Parser.rule(r"\\begin{(" + envs + r")}\[([^\]]*)\]\n\\label{(.*)}")
+@Parser.rule(r"\\begin{(" + envs + r")}\[([^\]]*)\]\n\\label{(.*)}", numbering=True)
 def __(parser, environ, title, label):
     parser.math_mode = False
     parser.subsection_number += 1
@@ -632,7 +2887,8 @@ def __(parser, environ, title, label):
         parser.section_number,
         parser.subsection_number
     )
-    return parser.format_with_tag(env_tmpl2, label, number, title=title, env=environ)
+    return parser.format_with_tag(env_tmpl2, label, number, title=title, env=environ,
+                                  lazy=parser.lazy_class)
 
 @Parser.rule(r"\\end{(" + envs + ")}")
 def __(parser, environ):
@@ -642,22 +2898,29 @@ def __(parser, environ):
 @Parser.rule(r"\\begin{proof}")
 def __(parser):
     parser.math_mode = False
+    if parser.lazy_math:
+        return ("\n<details class='proof{}'>\n"
+                "<summary class='proof-header'>proof</summary>\n"
+                .format(parser.lazy_class))
     return "\n<div class='proof'>\n<span class='proof-header'>proof</span>\n"
 
 @Parser.rule(r"\\end{proof}")
 def __(parser):
     parser.math_mode = False
+    if parser.lazy_math:
+        return "\n</details>\n"
     return "\n</div>\n"
 
 eqn_tmpl="""
-<div class='equation' id='{tag}'>{tagdiv}
+<div class='equation{lazy}' id='{tag}'>{tagdiv}
 <span class='equation-label'>{number}</span>
 $$
 """
 
-@Parser.rule(r"\\begin{equation}\n\\label{(.*)}")
+@Parser.rule(r"\\begin{equation}\n\\label{(.*)}", numbering=True)
 def __(parser, label):
     parser.math_mode = True
+    parser.math_fragments += 1
     parser.equation_number += 1
     number = "{}.{}.{}.{}".format(
         parser.chapter_number, 
@@ -665,32 +2928,32 @@ def __(parser, label):
         parser.subsection_number,
         parser.equation_number
     )
-    return parser.format_with_tag(eqn_tmpl, label, number)
+    return parser.format_with_tag(eqn_tmpl, label, number, lazy=parser.lazy_class)
 
 @Parser.rule(r"\\end{equation}")
 def __(parser):
     parser.math_mode = False
     return "\n$$\n</div>\n"
 
-@Parser.rule(r"\\begin{enumerate}")
+@Parser.rule(r"\\begin{enumerate}", numbering=True)
 def __(parser):
     parser.math_mode = False
     parser.item_number = 1
     return "\n<ol>\n"
 
-@Parser.rule(r"\\end{enumerate}")
+@Parser.rule(r"\\end{enumerate}", numbering=True)
 def __(parser):
     parser.math_mode = False
     parser.item_number = 0
     return "\n</ol>\n"
 
-@Parser.rule(r"\\begin{itemize}")
+@Parser.rule(r"\\begin{itemize}", numbering=True)
 def __(parser):
     parser.math_mode = False
     parser.item_number = 1
     return "\n<ul>\n"
 
-@Parser.rule(r"\\end{itemize}")
+@Parser.rule(r"\\end{itemize}", numbering=True)
 def __(parser):
     parser.math_mode = False
     parser.item_number = 0
@@ -730,21 +2993,21 @@ def __(parser):
 def __(parser):
     pass
 
-@Parser.rule(r"(\\bigskip)")
+@Parser.rule(r"(\\bigskip)", math=False)
 def __(parser, s):
     if parser.math_mode:
         return s
     else:
         return "\n<p>\n"
 
-@Parser.rule(r"(\\copyright)")
+@Parser.rule(r"(\\copyright)", math=False)
 def __(parser, s):
     if parser.math_mode:
         return s
     else:
         return "&copy;"
 
-@Parser.rule(r"\\item(.*)\n\\label{(.*)}")
+@Parser.rule(r"\\item(.*)\n\\label{(.*)}", numbering=True)
 def __(parser, tail, label):
     parser.math_mode = False
     number = parser.item_number
@@ -754,7 +3017,7 @@ def __(parser, tail, label):
         tail = parser.parse(tail)
     return parser.format_with_tag(tmpl, label, number, tail=tail)
 
-@Parser.rule(r"\\item\[([^\]]*)\]")
+@Parser.rule(r"\\item\[([^\]]*)\]", numbering=True)
 def __(parser, c):
     parser.math_mode = False
     parser.item_number += 1
@@ -762,7 +3025,7 @@ def __(parser, c):
     out += "<span class='counter'>" + c + "</span>\n"
     return out
 
-@Parser.rule(r"\\item")
+@Parser.rule(r"\\item", numbering=True)
 def __(parser):
     parser.math_mode = False
     parser.item_number += 1
@@ -801,42 +3064,42 @@ def __(parser, env):
     parser.math_mode = False
     return parser.decrease_bracket_level()
 
-@Parser.rule(r"~")
+@Parser.rule(r"~", math=False)
 def __(parser):
     if parser.math_mode:
         return "~"
     else:
         return "&nbsp;"
 
-@Parser.rule(r"``")
+@Parser.rule(r"``", math=False)
 def __(parser):
     if parser.math_mode:
         return "``"
     else:
         return "&#8220;"
 
-@Parser.rule(r"''")
+@Parser.rule(r"''", math=False)
 def __(parser):
     if parser.math_mode:
         return "''"
     else:
         return "&#8221;"
 
-@Parser.rule(r"---")
+@Parser.rule(r"---", math=False)
 def __(parser):
     if parser.math_mode:
         return "---"
     else:
         return "&mdash;"
 
-@Parser.rule(r"--")
+@Parser.rule(r"--", math=False)
 def __(parser):
     if parser.math_mode:
         return "--"
     else:
         return "&ndash;"
 
-@Parser.rule(r"\.\\ ")
+@Parser.rule(r"\.\\ ", math=False)
 def __(parser):
     if parser.math_mode:
         return ".\\ "
@@ -928,7 +3191,7 @@ def __(parser, c):
     else:
         return "\\v{" + c + "}"
 
-@Parser.rule(r"(\\%)")
+@Parser.rule(r"(\\%)", math=False)
 def __(parser, s):
     if not parser.math_mode:
         return "%"
@@ -941,10 +3204,119 @@ def __(parser, s):
 
 Parser.compile_regex()
 
+def _parse_chapter(args):
+    chapter_name, method = args
+    parser = Parser(chapter_name)
+    getattr(parser, method)()
+    state = dict((attr, getattr(parser, attr)) for attr in Parser.parse_results)
+    return chapter_name, state
+
 #######################################################################
 # 
 #######################################################################
 
 if __name__ == "__main__":
-    chapters = sys.argv[1:]
-    Parser.process(*chapters)
+    import argparse
+    arg_parser = argparse.ArgumentParser(
+        description="Convert Stacks Project chapters to HTML.")
+    arg_parser.add_argument("chapters", nargs="*",
+        help="chapters to process (default: the whole book)")
+    arg_parser.add_argument("-j", "--jobs", type=int, default=1,
+        help="number of processes used to parse chapters")
+    arg_parser.add_argument("-f", "--force", action="store_true",
+        help="rebuild every chapter, even if web/ is up to date")
+    arg_parser.add_argument("--relink", action="store_true",
+        help="only link and wrap pages again, from the division bodies "
+             "cached in .cache/prelink/ by earlier builds, against the current "
+             "tag index, and write those that changed; parses no TeX")
+    arg_parser.add_argument("--low-memory", action="store_true",
+        help="number the whole book first, then render, write and free "
+             "one chapter at a time")
+    arg_parser.add_argument("--pipeline", action="store_true",
+        help="like --low-memory, but link and write pages in background "
+             "threads while the next chapters are parsed")
+    arg_parser.add_argument("--writers", type=int, default=4,
+        help="number of writer threads of --pipeline (default: 4)")
+    arg_parser.add_argument("--profile-rules", action="store_true",
+        help="time every parser rule and write the figures per chapter and "
+             "for the book to web/rule_profile.json and .csv")
+    arg_parser.add_argument("--stats", action="store_true",
+        help="print the build report (always written to "
+             "web/build_report.json)")
+    arg_parser.add_argument("--divisions", type=DivisionPolicy.from_spec,
+        help="budgets after which the next section starts a new page: "
+             "source=BYTES of TeX, output=BYTES of HTML and math=FRAGMENTS, "
+             "and bundle=N to also start one at about every Nth section, "
+             "chosen by tag; comma separated (default: source=32768, or "
+             "source=65536,bundle=4 with --layout tags)")
+    arg_parser.add_argument("--layout", choices=["numbered", "tags"],
+        default="numbered",
+        help="name pages <chapter>-NNN.html (default), or after the tag of "
+             "their first section, which keeps their names and links "
+             "stable across unrelated edits")
+    arg_parser.add_argument("--minify", action="store_true",
+        help="strip redundant whitespace from pages, outside of math and "
+             "<pre>")
+    arg_parser.add_argument("--compress", action="store_true",
+        help="write .gz (and .br, with the brotli module) siblings of the "
+             "pages and static files in web/, for nginx's gzip_static")
+    arg_parser.add_argument("--assets", choices=StaticAssets.modes,
+        default="cdn",
+        help="load static files by their plain names and MathJax from its "
+             "CDN (default), by content hashed names (fingerprint), or "
+             "also inline the stylesheets and load MathJax from "
+             "static/vendor/ (local)")
+    arg_parser.add_argument("--tag-map-prefix", default="/",
+        help="path or URL web/ is served under, for the locations in "
+             "web/tag_map.conf (default: /)")
+    arg_parser.add_argument("--fragments", action="store_true",
+        help="also write the chapter div of every page to <page>.frag.html "
+             "and add prefetch hints and static/nav.js, which turns pages "
+             "without reloading")
+    arg_parser.add_argument("--lazy-math", action="store_true",
+        help="typeset theorems, equations and proofs only as they come into "
+             "view (static/lazy_math.js), and fold proofs")
+    arg_parser.add_argument("--output", action="append",
+        choices=list(output_backends),
+        help="also write the plain text of every page to <page>.txt "
+             "(text), the tags of every chapter with their HTML and text "
+             "to <chapter>.json (json) or a page for every section, "
+             "environment and equation to tag_<TAG>.html, which tag badges "
+             "then link to (tag-pages), from one structured form of the "
+             "parsed bodies that is cached in .cache/prelink/; repeatable")
+    arg_parser.add_argument("--lexer", choices=["alternation", "first-char"],
+        default="alternation",
+        help="match rules with one big alternation (default) or dispatch "
+             "on the first character of each candidate match")
+    args = arg_parser.parse_args()
+    Parser.lexer = args.lexer
+    Parser.low_memory = args.low_memory or args.pipeline
+    Parser.pipeline = args.pipeline
+    Parser.writers = args.writers
+    Parser.jobs = args.jobs
+    Parser.incremental = not args.force
+    Parser.relink = args.relink
+    if args.relink and Parser.low_memory:
+        arg_parser.error("--relink needs the pre-link cache, which "
+                         "--low-memory and --pipeline do not keep")
+    Parser.stats = args.stats
+    Parser.layout = args.layout
+    Parser.assets = StaticAssets(args.assets)
+    Parser.fragments = args.fragments
+    Parser.backends = [ output_backends[name]()
+                        for name in sorted(set(args.output or [])) ]
+    Parser.tag_pages = "tag-pages" in (args.output or [])
+    TagMap.prefix = args.tag_map_prefix
+    if args.lazy_math:
+        Parser.lazy_math = True
+        Parser.lazy_class = " lazy-math tex2jax_ignore"
+    if args.minify or args.compress:
+        Parser.compressor = OutputCompressor(args.minify, args.compress)
+    if args.divisions is not None:
+        Parser.division_policy = args.divisions
+    elif args.layout == "tags":
+        Parser.division_policy = DivisionPolicy(source=64*1024, bundle=4)
+    if args.profile_rules:
+        Parser.profile = RuleProfile(Parser)
+        Parser.profile.install()
+    Parser.process(*args.chapters)
@@ -1,26 +1,147 @@
 #!/usr/bin/env python
 
-from os.path import dirname, realpath, join
+from os.path import dirname, realpath, join, isdir
+import hashlib
+import marshal
+import os
 import sys
 
 script_dir = dirname(realpath(__file__))
-stacks_dir = join(script_dir, "stacks-project")
+# STACKS_PROJECT_DIR points the build at another checkout, or at a
+# synthetic one (see bench/gen_corpus.py).
+stacks_dir = os.environ.get("STACKS_PROJECT_DIR",
+                            join(script_dir, "stacks-project"))
 sys.path.append(join(stacks_dir, "scripts"))
 
-import functions
+# Reading the tables below through functions means parsing the whole tags
+# file, so the ones a build needs are kept in a marshal file in web/,
+# which is checked against the sizes and mtimes of the files they come
+# from, and against their hashes when those changed.  The chapter list is
+# read from the Makefile of the stacks-project checkout (chapters.tex in
+# synthetic ones); files that are not there are stamped as missing.  Nothing is read
+# before the tables are first used: chapters, label_types and tags are
+# looked up by __getattr__.  tags and tag2label are rarely needed, and
+# still read through functions.
+cache_file = join(dirname(script_dir), "web", "stacks_project_info.cache")
+cache_version = 2
+source_files = [
+    join(stacks_dir, "tags", "tags"),
+    join(stacks_dir, "Makefile"),
+    join(stacks_dir, "chapters.tex"),
+    join(stacks_dir, "scripts", "functions.py"),
+]
 
-chapters = functions.list_text_files(join(stacks_dir, ""))
-label_types = functions.list_of_standard_labels
-tags = functions.get_tags(join(stacks_dir, ""))
+_label_of_tag = None
+_tag_of_label = None
+_chapter_numbers = None
 
-_label_of_tag = dict(tags)
-_tag_of_label = dict((l,t) for (t,l) in tags)
+def _stamps():
+    stamps = []
+    for path in source_files:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            stamps.append(None)
+        else:
+            stamps.append([stat.st_size, stat.st_mtime_ns])
+    return stamps
+
+def _digests():
+    digests = []
+    for path in source_files:
+        try:
+            with open(path, "rb") as source_file:
+                digests.append(hashlib.sha1(source_file.read()).hexdigest())
+        except (IOError, OSError):
+            digests.append(None)
+    return digests
+
+def _read_cache():
+    try:
+        with open(cache_file, "rb") as cache:
+            tables = marshal.loads(cache.read())
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        return None
+    if not isinstance(tables, dict) or tables.get("version") != cache_version:
+        return None
+    stamps = _stamps()
+    if tables["stamps"] == stamps:
+        return tables
+    if tables["digests"] == _digests():
+        # Touched, but not changed.
+        tables["stamps"] = stamps
+        _write_cache(tables)
+        return tables
+    return None
+
+def _write_cache(tables):
+    if not isdir(dirname(cache_file)):
+        return
+    new_file = "{}.{}".format(cache_file, os.getpid())
+    try:
+        with open(new_file, "wb") as cache:
+            cache.write(marshal.dumps(tables))
+        os.replace(new_file, cache_file)
+    except (IOError, OSError):
+        pass
+
+def _build_tables():
+    import functions
+    stamps = _stamps()
+    digests = _digests()
+    chapters = functions.list_text_files(join(stacks_dir, ""))
+    tags = functions.get_tags(join(stacks_dir, ""))
+    return dict(
+        version=cache_version,
+        stamps=stamps,
+        digests=digests,
+        chapters=chapters,
+        label_types=list(functions.list_of_standard_labels),
+        tag_of_label=dict((l,t) for (t,l) in tags),
+        chapter_numbers=dict((name, n+1) for n, name
+                             in reversed(list(enumerate(chapters)))),
+    )
+
+def _load():
+    global chapters, label_types, _tag_of_label, _chapter_numbers
+    tables = _read_cache()
+    if tables is None:
+        tables = _build_tables()
+        _write_cache(tables)
+    chapters = tables["chapters"]
+    label_types = tables["label_types"]
+    _tag_of_label = tables["tag_of_label"]
+    _chapter_numbers = tables["chapter_numbers"]
+
+def _load_tags():
+    global tags, _label_of_tag
+    import functions
+    tags = functions.get_tags(join(stacks_dir, ""))
+    _label_of_tag = dict(tags)
+
+def __getattr__(name):
+    if name in ("chapters", "label_types"):
+        _load()
+        return globals()[name]
+    if name == "tags":
+        _load_tags()
+        return tags
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
 def tag2label(tag):
+    if _label_of_tag is None:
+        _load_tags()
     return _label_of_tag[tag]
 
 def label2tag(label):
+    if _tag_of_label is None:
+        _load()
     return _tag_of_label[label]
 
 def chapter_number(name):
-    return chapters.index(name)+1
+    if _chapter_numbers is None:
+        _load()
+    try:
+        return _chapter_numbers[name]
+    except KeyError:
+        raise ValueError("{!r} is not a chapter".format(name))
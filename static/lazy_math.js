@@ -0,0 +1,66 @@
+// Typesetting on demand, for pages built with --lazy-math.  Theorems,
+// equations and proofs carry the classes lazy-math and tex2jax_ignore, so
+// MathJax leaves them alone when the page loads.  Each is typeset when it
+// comes near the viewport, proofs only once they are unfolded, together
+// with the blocks nested in them.
+(function() {
+    "use strict";
+
+    var observer = null;
+
+    function whenReady(action) {
+        if (window.MathJax && MathJax.Hub && MathJax.Hub.Queue) {
+            action();
+        } else {
+            setTimeout(function() { whenReady(action); }, 50);
+        }
+    }
+
+    function typeset(block) {
+        if (block.getAttribute("data-typeset")) {
+            return;
+        }
+        var blocks = [block].concat(
+            Array.prototype.slice.call(block.querySelectorAll(".lazy-math")));
+        blocks.forEach(function(element) {
+            element.setAttribute("data-typeset", "1");
+            element.classList.remove("tex2jax_ignore");
+            if (observer) {
+                observer.unobserve(element);
+            }
+        });
+        whenReady(function() {
+            MathJax.Hub.Queue(["Typeset", MathJax.Hub, block]);
+        });
+    }
+
+    // Also called by nav.js on the chapter div it swaps in.
+    window.stacksLazyMath = function(root) {
+        var blocks = root.querySelectorAll(".lazy-math");
+        Array.prototype.forEach.call(blocks, function(block) {
+            if (block.tagName === "DETAILS") {
+                block.addEventListener("toggle", function() {
+                    if (block.open) {
+                        typeset(block);
+                    }
+                });
+            } else if (observer) {
+                observer.observe(block);
+            } else {
+                typeset(block);
+            }
+        });
+    };
+
+    if ("IntersectionObserver" in window) {
+        observer = new IntersectionObserver(function(entries) {
+            entries.forEach(function(entry) {
+                if (entry.isIntersecting) {
+                    typeset(entry.target);
+                }
+            });
+        }, { rootMargin: "800px 0px" });
+    }
+
+    window.stacksLazyMath(document);
+})();
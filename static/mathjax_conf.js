@@ -1,6 +1,9 @@
 window.MathJax = { AuthorInit: function() {
 
-    MathJax.Ajax.config.path["Contrib"] = "http://cdn.mathjax.org/mathjax/contrib";
+    // cdn.mathjax.org is retired; the third-party extensions for MathJax 2
+    // are in the legacy/ directory of their repository.
+    MathJax.Ajax.config.path["Contrib"] =
+        "https://cdn.jsdelivr.net/gh/mathjax/MathJax-third-party-extensions@master/legacy";
 
     MathJax.Hub.Config({
         extensions: ["tex2jax.js"],
@@ -27,10 +30,15 @@ window.MathJax = { AuthorInit: function() {
 }};
 
 window.onload = function() {
-    var next_url = document.getElementById("nav-next").href;
     window.onkeyup = function(ev) {
       var key = event.keyCode || event.which;
       if (key == 39) {
+          // Read at every key press: nav.js swaps the nav bar.
+          var next_url = document.getElementById("nav-next").href;
+          if (window.stacksNavigate && next_url) {
+              window.stacksNavigate(next_url);
+              return;
+          }
           window.history.forward();
           window.location.href = next_url;
       }
@@ -0,0 +1,106 @@
+// Page turns without reloads, for pages built with --fragments.  Links to
+// other pages of the book load the page's chapter div from
+// <page>.frag.html, swap it in for the current one, typeset only that and
+// push the page onto the history.  Whatever goes wrong falls back to
+// loading the whole page.
+(function() {
+    "use strict";
+
+    var fragments = {};
+    var shown = location.href.split("#")[0];
+
+    function isPage(a) {
+        return a.origin === location.origin &&
+               /\.html$/.test(a.pathname) &&
+               !/\.frag\.html$/.test(a.pathname) &&
+               !/(^|\/)index\.html$/.test(a.pathname);
+    }
+
+    function fragment(page) {
+        var url = page.replace(/\.html$/, ".frag.html");
+        if (!fragments[url]) {
+            fragments[url] = fetch(url).then(function(response) {
+                if (!response.ok) {
+                    throw new Error(url + ": " + response.status);
+                }
+                return response.text();
+            });
+            fragments[url].catch(function() {
+                delete fragments[url];
+            });
+        }
+        return fragments[url];
+    }
+
+    function prefetch() {
+        ["nav-next", "nav-prev"].forEach(function(id) {
+            var a = document.getElementById(id);
+            if (a && a.href && isPage(a)) {
+                fragment(a.href.split("#")[0]).catch(function() {});
+            }
+        });
+    }
+
+    function show(url, push) {
+        var page = url.split("#")[0];
+        var hash = url.split("#")[1];
+        return fragment(page).then(function(html) {
+            var holder = document.createElement("div");
+            holder.innerHTML = html;
+            var fresh = holder.querySelector(".chapter");
+            var current = document.querySelector(".chapter");
+            if (!fresh || !current) {
+                throw new Error(page + ": no chapter div");
+            }
+            current.parentNode.replaceChild(fresh, current);
+            shown = page;
+            if (push) {
+                history.pushState(null, "", url);
+            }
+            var target = hash && document.getElementById(hash);
+            if (target) {
+                target.scrollIntoView();
+            } else {
+                window.scrollTo(0, 0);
+            }
+            if (window.MathJax && MathJax.Hub) {
+                MathJax.Hub.Queue(["Typeset", MathJax.Hub, fresh]);
+            }
+            if (window.stacksLazyMath) {
+                window.stacksLazyMath(fresh);
+            }
+            prefetch();
+        });
+    }
+
+    // Also used by the arrow keys of mathjax_conf.js.
+    window.stacksNavigate = function(url) {
+        show(url, true).catch(function() {
+            location.href = url;
+        });
+        return true;
+    };
+
+    document.addEventListener("click", function(ev) {
+        if (ev.defaultPrevented || ev.button !== 0 || ev.metaKey ||
+                ev.ctrlKey || ev.shiftKey || ev.altKey) {
+            return;
+        }
+        var a = ev.target.closest ? ev.target.closest("a[href]") : null;
+        if (!a || !isPage(a) || a.href.split("#")[0] === shown) {
+            return;
+        }
+        ev.preventDefault();
+        window.stacksNavigate(a.href);
+    });
+
+    window.addEventListener("popstate", function() {
+        if (location.href.split("#")[0] !== shown) {
+            show(location.href, false).catch(function() {
+                location.reload();
+            });
+        }
+    });
+
+    prefetch();
+})();